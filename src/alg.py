@@ -7,8 +7,9 @@ from pathlib import Path
 import sage.all
 
 import settings
-from helpers.miscs import Miscs
+from helpers.miscs import Miscs, Z3
 import helpers.vcommon as CM
+import helpers.pool
 
 import data.prog
 from data.traces import Inps, DTraces
@@ -96,7 +97,8 @@ class DigSymStates(Dig):
         self.inv_decls = self.mysrc.inv_decls
 
         self.prog = data.prog.Prog(
-            self.exe_cmd, self.inp_decls, self.inv_decls)
+            self.exe_cmd, self.inp_decls, self.inv_decls,
+            self.batch_cmd, self.server_cmd)
         self.use_rand_init = True
 
         self.symstates = None
@@ -115,6 +117,10 @@ class DigSymStates(Dig):
 
         self.locs = self.inv_decls.keys()
 
+        # the workers inherit prog and symstates, which no longer change
+        helpers.pool.get_pool().start(
+            [self.prog] + ([self.symstates] if self.symstates else []))
+
         mlog.info('infer invs at {} locs: {}'.format(
             len(self.locs), ', '.join(self.locs)))
 
@@ -154,6 +160,8 @@ class DigSymStates(Dig):
         Clean up tmpdir
         """
         # clean up
+        self.prog.stop()  # the trace server uses files in tmpdir
+        helpers.pool.get_pool().stop()
         import shutil
         shutil.rmtree(self.tmpdir_del)
 
@@ -161,6 +169,11 @@ class DigSymStates(Dig):
         from analysis import Result, Analysis
 
         self.symstates.get_solver_stats()
+        mlog.debug("z3 parse cache (main process): {} hits, {} misses".format(
+            Z3.parse_hits, Z3.parse_misses))
+        if helpers.pool.get_pool().timeouts:
+            mlog.warning("timed out tasks: {}".format(
+                helpers.pool.get_pool().timeouts))
         result = Result(self.filename, self.seed,
                         dinvs, dtraces, inps,
                         self.symstates.solver_stats_,
@@ -237,6 +250,23 @@ class DigSymStatesJava(DigSymStates):
         return settings.Java.JAVA_RUN(
             tracedir=self.mysrc.tracedir, funname=self.mysrc.funname)
 
+    @property
+    def batch_cmd(self):
+        if not (settings.DO_BATCH_TRACES and
+                settings.Java.BATCH_RUN_CLASS.is_file()):
+            return None
+        return settings.Java.JAVA_BATCH_RUN(
+            tracedir=self.mysrc.tracedir, funname=self.mysrc.funname)
+
+    @property
+    def server_cmd(self):
+        if not (settings.DO_TRACE_SERVER and
+                settings.Java.BATCH_RUN_CLASS.is_file()):
+            return None
+        return settings.Java.JAVA_SERVER_RUN(
+            tracedir=self.mysrc.tracedir, funname=self.mysrc.funname,
+            timeout=settings.PROG_TIMEOUT * 1000)
+
 
 class DigSymStatesC(DigSymStates):
 
@@ -256,6 +286,16 @@ class DigSymStatesC(DigSymStates):
     def exe_cmd(self):
         return settings.C.C_RUN(exe=self.mysrc.traceexe)
 
+    @property
+    def batch_cmd(self):
+        if self.mysrc.batchexe is None:
+            return None
+        return settings.C.C_RUN(exe=self.mysrc.batchexe)
+
+    @property
+    def server_cmd(self):
+        return None  # running a C program on an inp is cheap
+
 
 class DigTraces(Dig):
     def __init__(self, tracefile, test_tracefile):
@@ -272,6 +312,7 @@ class DigTraces(Dig):
         assert maxdeg is None or maxdeg >= 1, maxdeg
 
         super().start(seed, maxdeg)
+        helpers.pool.get_pool().start()
 
         st = time.time()
 
@@ -311,10 +352,10 @@ class DigTraces(Dig):
 
     def infer_eqts(self, maxdeg, symbols, traces):
         auto_deg = self.get_auto_deg(maxdeg)
-        terms, template, uks, n_eqts_needed = Miscs.init_terms(
+        terms, n_eqts_needed = Miscs.init_terms(
             symbols.names, auto_deg, settings.EQT_RATE)
-        exprs = list(traces.instantiate(template, n_eqts_needed))
-        eqts = Miscs.solve_eqts(exprs, uks, template)
+        exprs = list(traces.instantiate(terms, n_eqts_needed))
+        eqts = Miscs.solve_eqts(exprs, terms)
         import data.inv.eqt
         return [data.inv.eqt.Eqt(eqt) for eqt in eqts]
 
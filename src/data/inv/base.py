@@ -1,8 +1,9 @@
 from abc import ABCMeta
 import pdb
+import math
 import operator
 
-from helpers.miscs import Z3
+from helpers.miscs import Miscs, Z3
 import helpers.vcommon as CM
 import settings
 import data.traces
@@ -84,6 +85,85 @@ class RelInv(Inv, metaclass=ABCMeta):
             s = "{} {}".format(s, self.stat)
         return s
 
+    @property
+    def monos(self):
+        """
+        monomials of lhs - rhs (see Miscs.get_monomials),
+        None if inv is not a polynomial relation
+        """
+        try:
+            return self._monos
+        except AttributeError:
+            self._monos = Miscs.get_monomials(self.inv.lhs() - self.inv.rhs())
+            return self._monos
+
+    def skip_mask(self, traces):
+        """
+        traces ignored when testing (see test_single_trace)
+        """
+        return traces.large_mask
+
+    def test(self, traces):
+        passed = self.test_traces([self], traces)[0]
+        return super().test(traces) if passed is None else passed
+
+    @classmethod
+    def test_traces(cls, invs, traces):
+        """
+        Test invs on all traces at once.
+        Each inv is compiled to a coefficient vector over the monomials
+        of all invs, so one matrix product gives the values of all invs
+        on all traces.
+
+        Return the results (True/False) of invs, None for
+        those that cannot be compiled (e.g., non-polynomial)
+        """
+        assert all(isinstance(inv, RelInv) for inv in invs), invs
+        assert isinstance(traces, data.traces.Traces), traces
+
+        rs = [None] * len(invs)
+        idxs = [i for i, inv in enumerate(invs) if inv.monos is not None]
+        if not idxs:
+            return rs
+
+        monos = sorted(set(mono for i in idxs for _, mono in invs[i].monos))
+        ss = tuple(sorted(set(s for mono in monos for s, _ in mono)))
+        exps = [tuple(dict(mono).get(s, 0) for s in ss) for mono in monos]
+        try:
+            vals = traces.eval_monomials(ss, exps)
+        except KeyError:  # some traces do not have values for ss
+            return rs
+
+        # integral coefs (as in Miscs.elim_denom), one column per inv
+        mono_idxs = {mono: j for j, mono in enumerate(monos)}
+        coefs = [[0] * len(idxs) for _ in monos]
+        for k, i in enumerate(idxs):
+            denom = 1
+            for c, _ in invs[i].monos:
+                d = c.denominator
+                denom = denom * d // math.gcd(denom, d)
+            for c, mono in invs[i].monos:
+                coefs[mono_idxs[mono]][k] = int(c * denom)
+
+        vals = traces.mydot(vals, coefs)
+        for k, i in enumerate(idxs):
+            inv = invs[i]
+            myop = inv.inv.operator()
+            vs = vals[:, k]
+            if myop == operator.eq:
+                oks = vs == 0
+            elif myop == operator.le:
+                oks = vs <= 0
+            else:
+                oks = vs < 0
+
+            skips = inv.skip_mask(traces)
+            if skips.any():
+                mlog.debug("{}: skip {} traces".format(inv, skips.sum()))
+            rs[i] = bool((oks | skips).all())
+
+        return rs
+
     def test_single_trace(self, trace):
         assert isinstance(trace, data.traces.Trace), trace
 
@@ -17,6 +17,9 @@ class Eqt(data.inv.base.RelInv):
         assert eqt.operator() == operator.eq, eqt
         super().__init__(eqt, stat)
 
+    def skip_mask(self, traces):
+        return super().skip_mask(traces) | traces.reprat_mask
+
     def test_single_trace(self, trace):
         assert isinstance(trace, data.traces.Trace), trace
 
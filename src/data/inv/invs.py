@@ -49,9 +49,20 @@ class Invs(set):
         # assert isinstance(traces, Traces)
         assert(self), self
 
-        def f(tasks):
-            return [(inv, inv.test(traces)) for inv in tasks]
-        wrs = Miscs.run_mp("test", list(self), f)
+        # test (polynomial) eqts and octs together
+        relinvs = [inv for inv in self
+                   if isinstance(inv, data.inv.base.RelInv)]
+        rs = data.inv.base.RelInv.test_traces(relinvs, traces)
+        wrs = [(inv, passed) for inv, passed in zip(relinvs, rs)
+               if passed is not None]
+
+        tasks = [inv for inv, passed in zip(relinvs, rs) if passed is None]
+        tasks.extend(inv for inv in self
+                     if not isinstance(inv, data.inv.base.RelInv))
+        if tasks:
+            def f(tasks):
+                return [(inv, inv.test(traces)) for inv in tasks]
+            wrs.extend(Miscs.run_mp("test", tasks, f))
 
         myinvs = set()
         for inv, passed in wrs:
@@ -77,8 +88,11 @@ class Invs(set):
             conj = z3.And(non_mps_exprs)
 
             def f(mps):
+                solver = Z3.create_solver(maximize=None)
+                solver.add(conj)
                 return [mp for mp in mps
-                        if not Z3._imply(conj, mp.expr(use_reals))]
+                        if Z3.get_models(z3.Not(mp.expr(use_reals)), k=1,
+                                         solver=solver)[0] is not False]
             wrs = Miscs.run_mp("simplifying {} mps".format(len(mps)), mps, f)
 
             mps = [mp for mp in wrs]
@@ -126,22 +140,22 @@ class Invs(set):
         octs = mysorted(octs)
         mps = mysorted(mps)
 
+        if is_conj and settings.DO_OCT_CLOSURE and octs:
+            octs = data.inv.oct.Oct.simplify(octs, use_reals)
+            if not (eqts or falseinvs or preposts or mps) and \
+                    all(inv.bound is not None for inv in octs):
+                # closure already removed all implied octs
+                Miscs.show_removed('_simplify', len(invs), len(octs),
+                                   time() - st)
+                return octs
+
         myinvs = eqts + falseinvs + preposts + octs + mps
         myinvs_exprs = [inv.expr(use_reals) for inv in myinvs]
 
-        def _imply(js, i):
-            iexpr = myinvs_exprs[i]
-            # don't consider/remove equality
-            if iexpr.decl().kind() == z3.Z3_OP_EQ:
-                ret = False
-            else:
-                jexprs = [myinvs_exprs[j] for j in js]
-                ret = Z3._imply(jexprs, iexpr, is_conj)
-            # if ret:
-            #     print '{} => {}'.format(jexprs, iexpr)
-            return ret
-
-        results = Miscs.simplify_idxs(list(range(len(myinvs))), _imply)
+        # don't consider/remove equality
+        keeps = set(i for i, iexpr in enumerate(myinvs_exprs)
+                    if iexpr.decl().kind() == z3.Z3_OP_EQ)
+        results = Z3.simplify_idxs(myinvs_exprs, is_conj, keeps)
         results = [myinvs[i] for i in results]
 
         Miscs.show_removed('_simplify', len(invs), len(results), time() - st)
@@ -1,6 +1,8 @@
 import operator
 import pdb
 
+import numpy
+
 import settings
 import helpers.vcommon as CM
 
@@ -19,3 +21,127 @@ class Oct(data.inv.base.RelInv):
                 myoct.operator() == operator.lt), myoct
 
         super().__init__(myoct, stat)
+
+    @property
+    def bound(self):
+        """
+        Return (((x1, s1), (x2, s2)), c) if this inv is s1*x1 + s2*x2 <= c
+        (or s1*x1 <= c), where s1, s2 are 1 or -1, and None otherwise
+
+        sage: var('x y')
+        (x, y)
+        sage: Oct(x - y <= 3).bound
+        ((('x', 1), ('y', -1)), 3)
+        sage: Oct(-2*x <= 3).bound
+        """
+        try:
+            return self._bound
+        except AttributeError:
+            self._bound = self._get_bound()
+            return self._bound
+
+    def _get_bound(self):
+        if self.inv.operator() != operator.le or self.monos is None:
+            return None
+
+        lits, c = [], 0
+        for coef, mono in self.monos:
+            if not mono:
+                c = -coef
+            elif len(mono) == 1 and mono[0][1] == 1 and coef in (1, -1):
+                lits.append((mono[0][0], int(coef)))
+            else:
+                return None
+
+        if not lits or len(lits) > 2 or \
+                (len(lits) == 2 and lits[0][0] == lits[1][0]):
+            return None
+        return tuple(sorted(lits)), c
+
+    @classmethod
+    def simplify(cls, octs, use_reals):
+        """
+        Remove octs implied by the other octs, using the closure of the
+        octagon instead of the solver (see simplify_bounds).
+        Octs that are not octagonal (e.g., nonlinear) are kept.
+        """
+        assert all(isinstance(inv, cls) for inv in octs), octs
+
+        bounds = [inv.bound for inv in octs]
+        idxs = [i for i, b in enumerate(bounds) if b is not None]
+        keeps = cls.simplify_bounds([bounds[i] for i in idxs], use_reals)
+        removes = set(idxs) - set(idxs[k] for k in keeps)
+        return [inv for i, inv in enumerate(octs) if i not in removes]
+
+    @classmethod
+    def simplify_bounds(cls, bounds, use_reals):
+        """
+        Like Z3.simplify_idxs, consider bounds in reversed order and
+        remove those implied by the remaining ones, where implication is
+        decided by the closure of the difference bound matrix (DBM).
+        Return the indices of the remaining bounds.
+
+        >>> bs = [((('x', 1),), 3), ((('y', 1),), 5),
+        ...       ((('x', 1), ('y', 1)), 8), ((('x', 1), ('y', -1)), 9)]
+        >>> Oct.simplify_bounds(bs, use_reals=False)  # y unbounded below
+        [0, 1, 3]
+        >>> bs = [((('x', 1), ('y', 1)), 3), ((('x', 1), ('y', -1)), 4),
+        ...       ((('x', 1),), 3)]
+        >>> Oct.simplify_bounds(bs, use_reals=False)  # 2x <= 7, x <= 3
+        [0, 1]
+        >>> Oct.simplify_bounds(bs, use_reals=True)
+        [0, 1, 2]
+        """
+        vs = sorted(set(v for lits, _ in bounds for v, _ in lits))
+        vidxs = {v: k for k, v in enumerate(vs)}
+
+        # V_2k is x_k and V_2k+1 is -x_k, m[p, q] bounds V_q - V_p, so
+        # a + b <= c is m[bar(b), a] <= c (and m[bar(a), b] <= c)
+        # and a <= c is m[bar(a), a] <= 2c
+        edges = []
+        for lits, c in bounds:
+            ps = [2 * vidxs[v] + (0 if s == 1 else 1) for v, s in lits]
+            if len(ps) == 1:
+                a = ps[0]
+                edges.append((a ^ 1, a, 2 * c))
+            else:
+                a, b = ps
+                edges.append((b ^ 1, a, c))
+
+        results = list(range(len(bounds)))
+        for i in reversed(range(len(bounds))):
+            others = [edges[j] for j in results if j != i]
+            m = cls.closure(2 * len(vs), others, use_reals)
+            if m is None:  # infeasible, leave it to the solver
+                return list(range(len(bounds)))
+            p, q, c = edges[i]
+            if m[p, q] <= c:
+                results.remove(i)
+        return results
+
+    @staticmethod
+    def closure(n, edges, use_reals):
+        """
+        Return the strong closure (tight closure if not use_reals) of
+        the n x n DBM with the given edges, or None if it is infeasible
+        """
+        m = numpy.full((n, n), numpy.inf)
+        numpy.fill_diagonal(m, 0.0)
+        for p, q, c in edges:
+            m[p, q] = min(m[p, q], c)
+            m[q ^ 1, p ^ 1] = min(m[q ^ 1, p ^ 1], c)  # coherence
+
+        for k in range(n):  # shortest paths
+            m = numpy.minimum(m, m[:, k:k + 1] + m[k:k + 1, :])
+
+        bars = numpy.arange(n) ^ 1
+        us = m[bars, numpy.arange(n)]  # bounds of 2*V_p
+        if not use_reals:  # tightening, 2*x <= c means 2*x <= 2*floor(c/2)
+            us = 2 * numpy.floor(us / 2)
+        # strengthening: V_q - V_p <= (bound(2V_q) + bound(2V_bar(p))) / 2
+        m = numpy.minimum(
+            m, (us[numpy.newaxis, :] + us[bars][:, numpy.newaxis]) / 2)
+
+        if (numpy.diag(m) < 0).any():
+            return None
+        return m
@@ -1,10 +1,14 @@
+import os
 import shlex
 import itertools
 import random
 from pathlib import Path
 import pdb
 from collections import namedtuple
+import signal
 import subprocess
+import threading
+import multiprocessing
 
 import sage.all
 
@@ -19,12 +23,22 @@ mlog = CM.getLogger(__name__, settings.logger_level)
 
 
 class Prog:
-    def __init__(self, exe_cmd, inp_decls, inv_decls):
+    def __init__(self, exe_cmd, inp_decls, inv_decls,
+                 batch_cmd=None, server_cmd=None):
+        """
+        batch_cmd (optional) runs the program on many inps,
+        one inp per line of stdin (see _get_traces_batch),
+        server_cmd (optional) starts a TraceServer that is used instead
+        """
         assert isinstance(exe_cmd, str), exe_cmd
         assert isinstance(inp_decls, Symbs), inp_decls  # I x, I y
         assert isinstance(inv_decls, DSymbs), inv_decls
+        assert batch_cmd is None or isinstance(batch_cmd, str), batch_cmd
+        assert server_cmd is None or isinstance(server_cmd, str), server_cmd
 
         self.exe_cmd = exe_cmd
+        self.batch_cmd = batch_cmd
+        self.server = TraceServer(server_cmd) if server_cmd else None
         self.inp_decls = inp_decls
         self.inv_decls = inv_decls
         self._cache = {}  # inp -> traces (str)
@@ -42,6 +56,10 @@ class Prog:
         assert all(loc in self.inv_decls for loc in traces), traces.keys()
         return traces
 
+    def stop(self):
+        if self.server:
+            self.server.stop()
+
     def gen_rand_inps(self, n_needed=1):
         assert n_needed >= 1, n_needed
         try:
@@ -68,18 +86,26 @@ class Prog:
         return inps
 
     # PRIVATE METHODS
+    @staticmethod
+    def _get_inp_str(inp):
+        inp_ = (v if isinstance(v, int) or v.is_integer() else v.n()
+                for v in inp.vs)
+        return ' '.join(map(str, inp_))
+
     def _get_traces(self, inp):
         assert isinstance(inp, data.traces.Inp), inp
 
-        inp_ = (v if isinstance(v, int) or v.is_integer() else v.n()
-                for v in inp.vs)
-        inp_ = ' '.join(map(str, inp_))
-        cmd = "{} {}".format(self.exe_cmd, inp_)
+        cmd = "{} {}".format(self.exe_cmd, self._get_inp_str(inp))
         mlog.debug(cmd)
 
         # do not check cmd status, could get error status due to incorrect input
-        cp = subprocess.run(shlex.split(cmd),
-                            capture_output=True, text=True)
+        try:
+            cp = subprocess.run(shlex.split(cmd), capture_output=True,
+                                text=True, timeout=settings.PROG_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            mlog.warning("{}: timeout ({}s), no traces".format(
+                cmd, settings.PROG_TIMEOUT))
+            return []
         traces = cp.stdout.splitlines()
         return traces
 
@@ -92,9 +118,26 @@ class Prog:
 
         tasks = [inp for inp in inps if inp not in self._cache]
 
-        def f(tasks):
-            return [(inp, self._get_traces(inp)) for inp in tasks]
-        wrs = Miscs.run_mp("get traces", tasks, f)
+        if self.server and self.server.is_usable and tasks:
+            # the server runs one inp at a time, so no need for workers
+            def run_f(inps):
+                return self.server.run([self._get_inp_str(inp)
+                                        for inp in inps])
+            wrs = self._get_traces_batch(tasks, run_f)
+        elif self.batch_cmd and len(tasks) >= 2:
+            # a few processes, each runs the program on many inps
+            n_cpus = multiprocessing.cpu_count() if settings.DO_MP else 1
+            n = min(n_cpus, len(tasks))
+            tasks = [tasks[i::n] for i in range(n)]
+
+            def f(tasks):
+                return [r for inps in tasks
+                        for r in self._get_traces_batch(inps)]
+            wrs = Miscs.run_mp("get traces", tasks, f)
+        else:
+            def f(tasks):
+                return [(inp, self._get_traces(inp)) for inp in tasks]
+            wrs = Miscs.run_mp("get traces", tasks, f)
 
         for inp, traces in wrs:
             assert inp not in self._cache
@@ -102,6 +145,107 @@ class Prog:
 
         return {inp: self._cache[inp] for inp in inps}
 
+    def _get_traces_batch(self, inps, run_f=None):
+        """
+        Run the program on inps using batch_cmd (or run_f, which is like
+        _run_batch), return [(inp, traces)].
+        An inp crashing the program (e.g., a failed assertion) is rerun
+        separately (see _get_traces), one running longer than
+        settings.PROG_TIMEOUT gets no traces,
+        and the program is restarted on the rest.
+        """
+        if run_f is None:
+            run_f = self._run_batch
+
+        rs = []
+        todo = list(inps)
+        while todo:
+            tracess, stat = run_f(todo)
+            n = len(tracess)
+            if stat == 'done':
+                rs.extend(zip(todo, tracess))
+                # inps not read by the program, e.g., it stopped early
+                rs.extend((inp, self._get_traces(inp)) for inp in todo[n:])
+                break
+
+            if n == 0:  # nothing started
+                rs.extend((inp, self._get_traces(inp)) for inp in todo)
+                break
+
+            # the last started inp did not finish
+            rs.extend(zip(todo[:n - 1], tracess))
+            inp = todo[n - 1]
+            if stat == 'timeout':
+                mlog.warning("{} {}: timeout ({}s), no traces".format(
+                    self.exe_cmd, self._get_inp_str(inp),
+                    settings.PROG_TIMEOUT))
+                rs.append((inp, []))
+            else:
+                rs.append((inp, self._get_traces(inp)))
+            todo = todo[n:]
+
+        return rs
+
+    def _run_batch(self, inps):
+        """
+        Run batch_cmd on inps, return the traces of the inps it started
+        and its status: 'done', 'timeout' (of the last started inp),
+        or 'crash'.
+        """
+        mlog.debug("{} ({} inps)".format(self.batch_cmd, len(inps)))
+        proc = subprocess.Popen(shlex.split(self.batch_cmd),
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, text=True,
+                                start_new_session=True)
+
+        def write():
+            try:
+                for inp in inps:
+                    proc.stdin.write(self._get_inp_str(inp) + "\n")
+                proc.stdin.close()
+            except (BrokenPipeError, OSError):  # program stopped
+                pass
+
+        is_timeout = []
+
+        def timeout():
+            is_timeout.append(True)
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+
+        # each inp has its own watchdog
+        tracess = []
+        indicator = settings.BATCH_INDICATOR + ":"
+        timer = threading.Timer(settings.PROG_TIMEOUT, timeout)
+        timer.start()
+        try:
+            for line in proc.stdout:
+                if line.startswith(indicator):
+                    timer.cancel()
+                    timer = threading.Timer(settings.PROG_TIMEOUT, timeout)
+                    timer.start()
+                    tracess.append([])
+                elif tracess:
+                    tracess[-1].append(line.rstrip("\n"))
+            proc.wait()
+        finally:
+            timer.cancel()
+            proc.stdout.close()
+        writer.join()
+
+        if is_timeout:
+            stat = 'timeout'
+        elif proc.returncode != 0:
+            stat = 'crash'
+        else:
+            stat = 'done'
+        return tracess, stat
+
     def _get_valid_inp_ranges(self):
 
         dr = {}  # Inp => range
@@ -147,6 +291,116 @@ class Prog:
         return rinps_i
 
 
+class TraceServer:
+    """
+    Client of a long-lived process running the program on inps,
+    e.g., a JVM with the program loaded once (BatchRun in server mode).
+    For each inp (a line of its stdin), the server prints "vinput: i",
+    the traces, and "vdone: i ok" (or "vdone: i timeout" if its
+    watchdog stopped the run).
+    """
+
+    def __init__(self, cmd):
+        assert isinstance(cmd, str), cmd
+        self.cmd = cmd
+        self.proc = None
+        self.pid = os.getpid()  # the owner, e.g., not a forked worker
+
+    @property
+    def is_usable(self):
+        # only the owner starts, uses, and stops the server
+        return self.pid == os.getpid()
+
+    def start(self):
+        mlog.debug("start trace server: {}".format(self.cmd))
+        self.proc = subprocess.Popen(shlex.split(self.cmd),
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, text=True,
+                                     start_new_session=True)
+
+    def stop(self):
+        if self.proc is None or not self.is_usable:
+            return
+        try:
+            self.proc.stdin.close()  # the server stops at EOF
+            self.proc.wait(timeout=settings.PROG_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+        self.proc = None
+
+    def kill(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def run(self, inps):
+        """
+        Run the program on inps (strs), return the traces of the inps
+        it started and the status like Prog._run_batch.
+        If the server died or hung, it is restarted at the next run.
+        """
+        assert self.is_usable
+        if self.proc is None:
+            self.start()
+        proc = self.proc
+
+        def write():
+            try:
+                for inp in inps:
+                    proc.stdin.write(inp + "\n")
+                proc.stdin.flush()
+            except (BrokenPipeError, OSError):  # server stopped
+                pass
+
+        is_timeout = []
+
+        def timeout():
+            is_timeout.append(True)
+            self.kill()
+
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+
+        # the server has its own watchdog, this one is for the server
+        tracess, ndone = [], 0
+        indicator = settings.BATCH_INDICATOR + ":"
+        done_indicator = settings.SERVER_INDICATOR + ":"
+        timer = threading.Timer(2 * settings.PROG_TIMEOUT, timeout)
+        timer.start()
+        try:
+            while ndone < len(inps):
+                line = proc.stdout.readline()
+                if not line:  # EOF, the server died
+                    break
+                if line.startswith(indicator):
+                    timer.cancel()
+                    timer = threading.Timer(
+                        2 * settings.PROG_TIMEOUT, timeout)
+                    timer.start()
+                    tracess.append([])
+                elif line.startswith(done_indicator):
+                    ndone += 1
+                    if line.split()[-1] == 'timeout':
+                        mlog.warning("{} {}: timeout ({}s), no traces".format(
+                            self.cmd, inps[len(tracess) - 1],
+                            settings.PROG_TIMEOUT))
+                        tracess[-1] = []
+                elif tracess:
+                    tracess[-1].append(line.rstrip("\n"))
+        finally:
+            timer.cancel()
+        writer.join()
+
+        if ndone == len(inps):
+            return tracess, 'done'
+
+        self.kill()
+        self.proc = None
+        return tracess, 'timeout' if is_timeout else 'crash'
+
+
 class Symb(namedtuple('Symb', ('name', 'typ'))):
     """
     Symbolic variable and its type,
@@ -178,6 +432,10 @@ class Symb(namedtuple('Symb', ('name', 'typ'))):
             self._expr = Z3.parse(str(self.sageExpr), use_reals)
             return self._expr
 
+    def __getstate__(self):
+        # z3 exprs cannot be pickled, recompute them after unpickling
+        return {k: v for k, v in self.__dict__.items() if k != '_expr'}
+
 
 class Symbs(tuple):
     def __new__(cls, ss):
@@ -204,6 +462,9 @@ class Symbs(tuple):
             self._exprs = [s.expr(use_reals) for s in self]
             return self._exprs
 
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k != '_exprs'}
+
     @classmethod
     def mk(cls, s):
         """
@@ -238,12 +499,16 @@ class Src:
 
         tracedir = self.mkdir(tmpdir / settings.TRACE_DIR)
         tracefile = tracedir / basename
+        # batch driver (see Prog._get_traces_batch), if supported
+        batchfile = tracedir / "{}_batch{}".format(
+            basename.stem, basename.suffix)
         symexedir = self.mkdir(tmpdir / settings.SYMEXE_DIR)
         symexefile = symexedir / basename
 
         cmd = self.instrument_cmd(filename=filename,
                                   tracefile=tracefile,
-                                  symexefile=symexefile)
+                                  symexefile=symexefile,
+                                  batchfile=batchfile)
         cp = subprocess.run(shlex.split(cmd),
                             capture_output=True, check=True, text=True)
 
@@ -251,6 +516,7 @@ class Src:
 
         self.filename, self.basename, self.funname = filename, basename, funname
         self.tracedir, self.tracefile = tracedir, tracefile
+        self.batchfile = batchfile
         self.symexedir, self.symexefile = symexedir, symexefile
         self.inp_decls, self.inv_decls, self.mainQ_name = \
             inp_decls, inv_decls, mainQ_name
@@ -311,6 +577,16 @@ class C(Src):
         self.traceexe = self.tracefile.with_suffix('.exe')
         self.compile_test(self.tracefile, self.traceexe)
 
+        self.batchexe = None
+        if settings.DO_BATCH_TRACES and self.batchfile.is_file():
+            batchexe = self.batchfile.with_suffix('.exe')
+            try:
+                self.compile_test(self.batchfile, batchexe)
+                self.batchexe = batchexe
+            except subprocess.CalledProcessError as ex:
+                mlog.warning("cannot compile {} ({}), run {} per inp".format(
+                    self.batchfile, ex, self.traceexe))
+
     def check(self, filename, tmpdir):
         basename = Path(filename.name)
         funname = basename.stem
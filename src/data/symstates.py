@@ -1,14 +1,22 @@
 """
 Symbolic States
 """
+import os
 import sys
 import shlex
+import json
+import hashlib
+import threading
+import signal
+import time
 from collections import defaultdict
 from abc import ABCMeta, abstractmethod
 import pdb
 from pathlib import Path
+import multiprocessing
 from multiprocessing import Queue
 import subprocess
+from fractions import Fraction
 
 import z3
 import sage.all
@@ -31,6 +39,8 @@ zFalse = z3.BoolVal(False)
 
 
 class PC(metaclass=ABCMeta):
+    can_tag_depths = False  # tool output gives the depth of each state
+
     def __init__(self, loc, depth, pc, slocal, use_reals):
         assert isinstance(loc, str) and loc, loc
         assert depth >= 0, depth
@@ -49,11 +59,38 @@ class PC(metaclass=ABCMeta):
         return 'loc: {}\npc: {}\nslocal: {}'.format(
             self.loc, self.pc, self.slocal)
 
+    @property
+    def fingerprint(self):
+        """
+        z3 hash-conses terms, so structurally equal exprs (in a process)
+        have the same ids, i.e., this identifies a PC without printing it
+        """
+        try:
+            return self._fingerprint
+        except AttributeError:
+            self._fingerprint = (
+                self.loc, self.pc.get_id(), self.slocal.get_id())
+            return self._fingerprint
+
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and hash(self) == hash(other)
+        return (isinstance(other, self.__class__) and
+                self.fingerprint == other.fingerprint)
 
     def __hash__(self):
-        return hash(self.__str__())
+        return hash(self.fingerprint)
+
+    def __getstate__(self):
+        # z3 exprs are sent as smt2 strings, e.g., to worker processes
+        d = dict(self.__dict__)
+        d.pop('_fingerprint', None)  # ids are per process
+        d['pc'] = helpers.miscs.Z3.to_smt2(self.pc)
+        d['slocal'] = helpers.miscs.Z3.to_smt2(self.slocal)
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.pc = helpers.miscs.Z3.from_smt2(d['pc'])
+        self.slocal = helpers.miscs.Z3.from_smt2(d['slocal'])
 
     @property
     def expr(self):
@@ -85,19 +122,23 @@ class PC_CIVL(PC):
         path condition: (0<=(X_x+(-1*X_y)))&&(0<=(X_x-1))&&(0<=(X_y-1))
         """
 
-        slocals = []
-        pcs = []
-        lines = [l.strip() for l in lines]
-        lines = [l for l in lines if l]
+        return list(cls.iparse_parts(lines))
+
+    @classmethod
+    def iparse_parts(cls, lines):
+        """
+        Like parse_parts but yield each part as soon as it is read,
+        e.g., lines can be the stdout of a running CIVL process
+        """
+        slocal = None
         for l in lines:
+            l = l.strip()
             if l.startswith('vtrace'):
-                slocals.append(l)
+                slocal = l
             elif l.startswith('path condition'):
-                assert len(pcs) == len(slocals) - 1
-                pcs.append(l)
-
-        parts = [[slocal, pc] for slocal, pc in zip(slocals, pcs)]
-        return parts
+                assert slocal is not None, l
+                yield [slocal, l]
+                slocal = None
 
     @classmethod
     def parse_part(cls, ss):
@@ -129,6 +170,7 @@ class PC_CIVL(PC):
 
 
 class PC_JPF(PC):
+    can_tag_depths = True  # see InvariantListenerVu
 
     @classmethod
     def parse_parts(cls, lines, delim="**********"):
@@ -145,29 +187,36 @@ class PC_JPF(PC):
         'CON: a = 0',
         'CON: b = 0']]
         """
-        parts, curpart = [], []
+        return list(cls.iparse_parts(lines, delim))
+
+    @classmethod
+    def iparse_parts(cls, lines, delim="**********"):
+        """
+        Like parse_parts but yield each part as soon as it is read,
+        e.g., lines can be the stdout of a running JPF process
+        """
+        curpart = []
 
         start = delim + " START"
         end = delim + " END"
         do_append = False
 
-        lines = [l.strip() for l in lines]
-        lines = [l for l in lines if l]
         for l in lines:
+            l = l.strip()
+            if not l:
+                continue
             if l.startswith(start):
                 do_append = True
                 continue
             elif l.startswith(end):
                 do_append = False
                 if curpart:
-                    parts.append(curpart)
+                    yield curpart
                     curpart = []
             else:
                 if do_append:
                     curpart.append(l)
 
-        return parts
-
     @classmethod
     def parse_part(cls, ss):
         """
@@ -186,6 +235,8 @@ class PC_JPF(PC):
                 loc = s.split()[1]  # e.g., vtrace30(I)V
                 loc = loc.split('(')[0]  # vtrace30
                 continue
+            elif s.startswith('depth: '):  # see get_depth
+                continue
             elif 'vars: ' in s:
                 pcs = curpart[1:]  # ignore pc constraint #
                 curpart = []
@@ -218,6 +269,20 @@ class PC_JPF(PC):
 
         return loc, pc, slocal
 
+    @classmethod
+    def get_depth(cls, ss):
+        """
+        Return the smallest depth limit at which the state is reached
+        (the 'depth: ' line of the part), None if not available
+
+        sage: PC_JPF.get_depth(['loc: vtrace1(II)V', 'depth: 9', 'pc: ...'])
+        9
+        """
+        for s in ss:
+            if s.startswith('depth: '):
+                return int(s.split()[1])
+        return None
+
     @staticmethod
     @cached_function
     def replace_str(s):
@@ -244,6 +309,18 @@ class PCs(set):
         assert isinstance(pc, PC), pc
         super().add(pc)
 
+    def __reduce__(self):
+        exprs = {k: helpers.miscs.Z3.to_smt2(self.__dict__[k])
+                 for k in ('_expr', '_pc') if k in self.__dict__}
+        return (self.__class__, (self.loc, self.depth), (list(self), exprs))
+
+    def __setstate__(self, state):
+        pcs, exprs = state
+        for pc in pcs:
+            self.add(pc)
+        for k, v in exprs.items():
+            setattr(self, k, helpers.miscs.Z3.from_smt2(v))
+
     @property
     def myexpr(self):
         try:
@@ -264,7 +341,8 @@ class PCs(set):
 
 
 class SymStatesMaker(metaclass=ABCMeta):
-    def __init__(self, filename, mainQName, funname, ninps, use_reals, tmpdir):
+    def __init__(self, filename, mainQName, funname, ninps, use_reals, tmpdir,
+                 locs=None):
         assert tmpdir.is_dir(), tmpdir
 
         self.filename = filename
@@ -273,19 +351,29 @@ class SymStatesMaker(metaclass=ABCMeta):
         self.tmpdir = tmpdir
         self.ninps = ninps
         self.use_reals = use_reals
+        self.locs = locs  # stop early when these locs have enough pcs
+        self.truncated = set()  # locs with pcs dropped by SE_MAX_PCS
 
     def compute(self):
         """
         Run symbolic execution to obtain symbolic states
         """
-        tasks = [depth for depth in range(self.mindepth, self.maxdepth+1)]
+        wrs = None
+        if settings.DO_SE_TAG_DEPTHS and self.pc_cls.can_tag_depths:
+            wrs = self.get_ss_tagged()
 
-        def f(tasks):
-            rs = [(depth, self.get_ss(depth)) for depth in tasks]
-            rs = [(depth, ss) for depth, ss in rs if ss]
-            return rs
+        if not wrs:
+            tasks = [depth for depth in range(self.mindepth, self.maxdepth+1)]
 
-        wrs = helpers.miscs.Miscs.run_mp("get symstates", tasks, f)
+            def f(tasks):
+                rs = [(depth, self.get_ss(depth)) for depth in tasks]
+                rs = [(depth, ss, self.truncated) for depth, ss in rs if ss]
+                return rs
+
+            wrs = helpers.miscs.Miscs.run_mp("get symstates", tasks, f)
+            for _, _, truncated in wrs:
+                self.truncated.update(truncated)
+            wrs = [(depth, ss) for depth, ss, _ in wrs]
 
         if not wrs:
             mlog.warning("cannot obtain symbolic states, unreachable locs?")
@@ -293,30 +381,243 @@ class SymStatesMaker(metaclass=ABCMeta):
 
         return self.merge(wrs, self.pc_cls, self.use_reals)
 
-    def get_ss(self, depth):
+    def get_ss_tagged(self):
+        """
+        Run symbolic execution once at maxdepth, where each state is tagged
+        with the smallest depth reaching it, instead of once per depth.
+        Return [(depth, states)] of states first reached at each depth
+        (the states at mindepth include those reached earlier)
+        """
+        pcs = self.get_ss(self.maxdepth, tag_depths=True)
+        if not pcs:
+            return None
+        if any(pc[-1] is None for pc in pcs):
+            mlog.warning("no depth info in symbolic states, "
+                         "run symbolic execution for each depth")
+            return None
+
+        depthss = defaultdict(list)
+        for loc, pc, slocal, depth in pcs:
+            depthss[max(depth, self.mindepth)].append((loc, pc, slocal))
+        return sorted(depthss.items())
+
+    def get_ss(self, depth, tag_depths=False):
         assert depth >= 1, depth
 
+        cachefile = (self.get_cachefile(depth, tag_depths)
+                     if settings.DO_SS_CACHE else None)
+        if cachefile and cachefile.is_file():
+            pcs = self.read_cache(cachefile)
+            if pcs is not None:
+                mlog.debug("Use cached symbolic states (depth {}): {}"
+                           .format(depth, cachefile))
+                return pcs
+
         cmd = self.mk(depth)
         mlog.debug("Obtain symbolic states (depth {})".format(depth))
         mlog.debug(cmd)
 
-        s = None
-        try:
-            cp = subprocess.run(
-                shlex.split(cmd), timeout=settings.SYMEXE_TIMEOUT,
-                capture_output=True, check=True, text=True)
-            s = cp.stdout
-        except subprocess.TimeoutExpired as ex:
-            mlog.warning("{}: {} time out after {}s".format(
-                ex.__class__.__name__, ' '.join(ex.cmd), ex.timeout))
-            s = ex.stdout
-
-        except subprocess.CalledProcessError as ex:
-            mlog.warning(ex)
+        pcs, is_complete = self.run(cmd, tag_depths)
+        if not pcs:
             return None
-        pcs = self.pc_cls.parse(s)
+
+        # only cache complete results, timeouts depend on the machine
+        if cachefile and is_complete:
+            self.write_cache(cachefile, pcs)
         return pcs
 
+    def run(self, cmd, tag_depths=False):
+        """
+        Run the symbolic executor and parse its output while it runs,
+        so that states obtained before a timeout are kept.
+        Stop early when each loc in self.locs has settings.SE_MAX_PCS pcs
+        (if set), the locs whose pcs are dropped are added to self.truncated.
+        If tag_depths, each pc also has its depth (see PC_JPF.get_depth).
+        Return the parsed pcs and whether the run completed.
+        """
+        maxpcs = settings.SE_MAX_PCS
+        ctrs = defaultdict(int)
+        pcs = []
+
+        # own process group so that kill also stops the tool's children
+        proc = subprocess.Popen(
+            shlex.split(cmd), stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, text=True, start_new_session=True)
+        timed_out = threading.Event()
+
+        def kill():
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        def timeout():
+            timed_out.set()
+            kill()
+
+        timer = threading.Timer(settings.SYMEXE_TIMEOUT, timeout)
+        timer.start()
+        is_stopped, is_truncated, is_read = False, False, False
+        try:
+            for part in self.pc_cls.iparse_parts(proc.stdout):
+                pc = self.pc_cls.parse_part(part)
+                if tag_depths:
+                    pc = pc + (self.pc_cls.get_depth(part),)
+                loc = pc[0]
+                if maxpcs and ctrs[loc] >= maxpcs:
+                    self.truncate([loc])
+                    is_truncated = True
+                    continue
+                ctrs[loc] += 1
+                pcs.append(pc)
+
+                if (maxpcs and self.locs and
+                        all(ctrs[l] >= maxpcs for l in self.locs)):
+                    mlog.debug("got {} pcs for each loc, stop".format(maxpcs))
+                    self.truncate(self.locs)
+                    is_stopped = True
+                    kill()
+                    break
+            is_read = True
+        finally:
+            timer.cancel()
+            if not is_read:  # e.g., parse error, don't wait for the tool
+                kill()
+            proc.stdout.close()
+            proc.wait()
+
+        if timed_out.is_set():
+            mlog.warning("{} time out after {}s ({} pcs)".format(
+                cmd, settings.SYMEXE_TIMEOUT, len(pcs)))
+        elif not is_stopped and proc.returncode != 0:
+            mlog.warning("{} returned non-zero exit status {}".format(
+                cmd, proc.returncode))
+            return None, False
+
+        if not pcs:
+            mlog.error("Cannot obtain symstates")
+
+        is_complete = not (timed_out.is_set() or is_stopped or is_truncated)
+        return pcs, is_complete
+
+    def truncate(self, locs):
+        for loc in locs:
+            if loc not in self.truncated:
+                mlog.warning("{}: keep only {} pcs (SE_MAX_PCS), "
+                             "its invs will not be proved".format(
+                                 loc, settings.SE_MAX_PCS))
+                self.truncated.add(loc)
+
+    def get_cachefile(self, depth, tag_depths=False):
+        """
+        Cached symbolic states are identified by the contents of the
+        files the symbolic executor runs (see artifacts), the version of
+        the tool (see tool_key), and the settings affecting its output,
+        so changing the program, the instrumenter, or the tool
+        invalidates them.
+        """
+        try:
+            filehash = self._filehash
+        except AttributeError:
+            h = hashlib.sha256()
+            for f in self.artifacts:
+                h.update(str(f.relative_to(self.tmpdir)
+                             if self.tmpdir in f.parents else f.name).encode())
+                h.update(f.read_bytes())
+            self._filehash = h.hexdigest()
+            filehash = self._filehash
+
+        key = (self.CACHE_VERSION, filehash, self.tool_key,
+               self.pc_cls.__name__, self.funname, self.mainQName,
+               self.ninps, self.use_reals, depth, tag_depths,
+               self.mindepth, self.maxdepth, settings.INP_MAX_V,
+               settings.SE_MAX_PCS, settings.LARGE_N)
+        key = hashlib.sha256(repr(key).encode()).hexdigest()
+        return settings.tmpdir / settings.SS_CACHE_DIR / "{}.json".format(key)
+
+    CACHE_VERSION = 2  # change when the format of cached pcs changes
+
+    @property
+    @abstractmethod
+    def artifacts(self):
+        """
+        Files run by the symbolic executor, e.g., the instrumented program
+        """
+        pass
+
+    @property
+    @abstractmethod
+    def tool_key(self):
+        """
+        Identify the symbolic executor (and its listener) version
+        """
+        pass
+
+    @staticmethod
+    def get_file_key(f):
+        try:
+            st = Path(f).stat()
+            return str(f), st.st_size, st.st_mtime_ns
+        except OSError:
+            return str(f), None, None
+
+    @staticmethod
+    def read_cache(cachefile):
+        try:
+            pcs = json.loads(CM.vread(cachefile))
+            os.utime(cachefile)  # recently used, see evict_cache
+        except (OSError, ValueError) as ex:
+            mlog.warning("cannot read {}: {}".format(cachefile, ex))
+            return None
+        return [tuple(pc) for pc in pcs]
+
+    @classmethod
+    def write_cache(cls, cachefile, pcs):
+        """
+        Save the parsed (loc, pc, slocal) of pcs,
+        the file is renamed in place so concurrent readers never see
+        partial contents
+        """
+        try:
+            cachefile.parent.mkdir(exist_ok=True)
+            tmpfile = cachefile.with_suffix(".{}.tmp".format(os.getpid()))
+            CM.vwrite(tmpfile, json.dumps([list(pc) for pc in pcs]))
+            tmpfile.replace(cachefile)
+        except OSError as ex:
+            mlog.warning("cannot write {}: {}".format(cachefile, ex))
+            return
+        cls.evict_cache(cachefile.parent)
+
+    @staticmethod
+    def evict_cache(cachedir):
+        """
+        Remove cached files not used for settings.SS_CACHE_MAX_AGE days,
+        then the least recently used ones until the cache is at most
+        settings.SS_CACHE_MAX_SIZE MB
+        """
+        try:
+            fs = []
+            for f in cachedir.glob("*.json"):
+                st = f.stat()
+                fs.append((st.st_mtime, st.st_size, f))
+        except OSError as ex:
+            mlog.warning("cannot read {}: {}".format(cachedir, ex))
+            return
+
+        now = time.time()
+        max_age = settings.SS_CACHE_MAX_AGE * 24 * 3600
+        max_size = settings.SS_CACHE_MAX_SIZE * 1024 * 1024
+        size = sum(siz for _, siz, _ in fs)
+        for mtime, siz, f in sorted(fs, key=lambda t: t[0]):
+            if now - mtime <= max_age and size <= max_size:
+                break
+            try:
+                f.unlink()
+                mlog.debug("remove cached symbolic states {}".format(f))
+            except OSError:  # e.g., removed by another run
+                pass
+            size -= siz
+
     @classmethod
     def merge(cls, depthss, pc_cls, use_reals):
         """
@@ -335,15 +636,14 @@ class SymStatesMaker(metaclass=ABCMeta):
         # only store incremental states at each depth
         for loc in symstates:
             depths = sorted(symstates[loc])
-            assert len(depths) >= 2, depths
-            for i in range(len(depths)):
-                iss = symstates[loc][depths[i]]
+            assert depths, depths
+            seen = set()
+            for depth in depths:
+                pcs = symstates[loc][depth]
                 # only keep diffs
-                for j in range(i):
-                    jss = symstates[loc][depths[j]]
-                    for s in jss:
-                        if s in iss:
-                            iss.remove(s)
+                for pc in [pc for pc in pcs if pc in seen]:
+                    pcs.remove(pc)
+                seen.update(pcs)
 
         # clean up
         empties = [(loc, depth) for loc in symstates
@@ -406,6 +706,14 @@ class SymStatesMakerC(SymStatesMaker):
         """
         return settings.C.CIVL_RUN(maxdepth=depth, file=self.filename)
 
+    @property
+    def artifacts(self):
+        return [Path(self.filename)]
+
+    @property
+    def tool_key(self):
+        return self.get_file_key(settings.C.CIVL_JAR)
+
 
 class SymStatesMakerJava(SymStatesMaker):
     pc_cls = PC_JPF
@@ -422,6 +730,20 @@ class SymStatesMakerJava(SymStatesMaker):
         max_val = settings.INP_MAX_V
         return settings.Java.JPF_RUN(jpffile=self.mk_JPF_runfile(max_val, depth))
 
+    @property
+    def artifacts(self):
+        # the (instrumented) classes in the classpath, not the .jpf files
+        return sorted(self.tmpdir.glob("**/*.class"))
+
+    @property
+    def tool_key(self):
+        listener = (settings.Java.JAVA_INSTRUMENT_DIR /
+                    "InvariantListenerVu.java")
+        return (self.get_file_key(settings.Java.JPF_JAR),
+                self.get_file_key(settings.Java.JPF_SYMBC_JAR),
+                hashlib.sha256(listener.read_bytes()).hexdigest(),
+                settings.Java.JVM_FLAGS)
+
     def mk_JPF_runfile(self, max_int, depth):
         assert max_int >= 0, max_int
 
@@ -472,15 +794,61 @@ class SymStates(dict):
         self.inv_decls = inv_decls
         self.use_reals = inv_decls.use_reals
         self.inp_exprs = inp_decls.exprs(self.use_reals)
+        self.truncated = set()  # locs missing pcs (see SymStatesMaker.run)
 
         super().__init__(dict())
 
+    def __getstate__(self):
+        # solvers and z3 exprs are not pickled, they are rebuilt lazily
+        return {k: v for k, v in self.__dict__.items()
+                if k not in {'_solvers', '_solvers_pid', 'inp_exprs'}}
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.inp_exprs = self.inp_decls.exprs(self.use_reals)
+
+    @property
+    def solvers(self):
+        """
+        Solvers with symstates asserted, (loc, depth, use_pc) -> solver.
+        They are created lazily and are per process, i.e., a forked worker
+        starts with an empty cache instead of using the parent's solvers.
+        """
+        pid = os.getpid()
+        if getattr(self, '_solvers_pid', None) != pid:
+            self._solvers = {}
+            self._solvers_pid = pid
+        return self._solvers
+
+    def get_solver(self, loc, depth, use_pc):
+        """
+        Return the solver for the symstates of loc at depth
+        (all depths if depth is None), using only the path conditions
+        if use_pc. The solver is reused so that z3 keeps its learned
+        lemmas across the checks at that (loc, depth).
+        """
+        key = (loc, depth, use_pc)
+        try:
+            return self.solvers[key]
+        except KeyError:
+            ssd = self[loc]
+            if depth is None:
+                ss = self.get_ss_at_depth(ssd, depth=None)
+            else:
+                ss = ssd[depth].mypc if use_pc else ssd[depth].myexpr
+            solver = helpers.miscs.Z3.create_solver(maximize=None)
+            solver.add(ss)
+            self.solvers[key] = solver
+            return solver
+
     def compute(self, symstatesmaker_cls, filename, mainQName, funname, tmpdir):
         symstatesmaker = symstatesmaker_cls(
-            filename, mainQName, funname, len(self.inp_decls), self.use_reals, tmpdir)
+            filename, mainQName, funname, len(self.inp_decls), self.use_reals,
+            tmpdir, locs=list(self.inv_decls))
         ss = symstatesmaker.compute()
         for loc in ss:
             self[loc] = SymStatesDepth(ss[loc])
+        self.truncated = set(symstatesmaker.truncated)
 
     # Checking invariants using symbolic states
 
@@ -498,28 +866,263 @@ class SymStates(dict):
                  if inv.stat is None]
         refsD = {(loc, str(inv)): inv for loc, inv in tasks}
 
-        def f(tasks):
-            return [(loc, str(inv),
-                     self.mcheck_d(loc, inv, inps, ncexs=1))
-                    for loc, inv in tasks]
-        wrs = helpers.miscs.Miscs.run_mp("prove", tasks, f)
+        if settings.DO_BATCH_CHECK:
+            tasks = self.mk_batches(tasks)
+
+            def f(tasks):
+                return [r for loc, invs in tasks
+                        for r in self.bcheck_d(loc, invs, inps)]
+        else:
+            def f(tasks):
+                rs = {}
+                for i, (loc, inv) in enumerate(tasks):
+                    if (loc, str(inv)) in rs:  # disproved by an earlier cex
+                        continue
+                    cexs, is_succ = self.mcheck_d(loc, inv, inps, ncexs=1)
+                    rs[(loc, str(inv))] = (cexs, is_succ)
+                    if not cexs:
+                        continue
+
+                    # test the cex on the other unchecked invs at loc
+                    others = [inv_ for loc_, inv_ in tasks[i+1:]
+                              if loc_ == loc and (loc, str(inv_)) not in rs]
+                    for inv_ in self.test_cexs(loc, cexs, others):
+                        rs[(loc, str(inv_))] = (cexs, True)
+                return [(loc, str_inv, r) for (loc, str_inv), r in rs.items()]
+
+        def cost(task):
+            loc, invs = task
+            invs = invs if isinstance(invs, list) else [invs]
+            kinds = tuple(sorted(set(type(inv).__name__ for inv in invs)))
+            return (loc, kinds), len(invs) * self.get_cost(loc)
+
+        def on_timeout(task):
+            loc, invs = task
+            invs = invs if isinstance(invs, list) else [invs]
+            for _ in invs:
+                self.put_solver_stats(analysis.CheckSolverCalls(z3.unknown))
+            return [(loc, str(inv), (None, False)) for inv in invs]
+
+        def timeout(task):
+            # each inv of a batch has its own solver calls
+            _, invs = task
+            return settings.TASK_TIMEOUT * (
+                len(invs) if isinstance(invs, list) else 1)
+
+        wrs = helpers.miscs.Miscs.irun_mp(
+            "prove", tasks, f, cost, timeout=timeout,
+            phase_timeout=settings.PHASE_TIMEOUT, on_timeout=on_timeout)
+
+        # test the cexs of each task on the unresolved invs at the same loc
+        # from the other tasks (e.g., batches of the loc on other cpus)
+        rs = {}
+        dcexs, unknowns = defaultdict(list), defaultdict(list)
+        for loc, str_inv, (cexs, is_succ) in wrs:
+            inv = refsD[(loc, str_inv)]
+            rs[(loc, str_inv)] = (cexs, is_succ)
+            if cexs:
+                dcexs[loc].extend(cexs)
+                for inv_ in self.test_cexs(loc, cexs, unknowns[loc]):
+                    rs[(loc, str(inv_))] = (cexs, True)
+                    unknowns[loc].remove(inv_)
+            elif not is_succ:
+                if self.test_cexs(loc, dcexs[loc], [inv]):
+                    rs[(loc, str_inv)] = (list(dcexs[loc]), True)
+                else:
+                    unknowns[loc].append(inv)
 
         mCexs = []
         mdinvs = data.inv.invs.DInvs()
-        for loc, str_inv, (cexs, is_succ) in wrs:
+        for (loc, str_inv), (cexs, is_succ) in rs.items():
             inv = refsD[(loc, str_inv)]
 
             if cexs:
                 stat = data.inv.base.Inv.DISPROVED
                 mCexs.append({loc: {str(inv): cexs}})
-            else:
-                stat = (data.inv.base.Inv.PROVED
-                        if is_succ else data.inv.base.Inv.UNKNOWN)
+            elif is_succ and loc not in self.truncated:
+                stat = data.inv.base.Inv.PROVED
+            else:  # also if only some of the symstates are checked
+                stat = data.inv.base.Inv.UNKNOWN
             inv.stat = stat
             mdinvs.setdefault(loc, data.inv.invs.Invs()).add(inv)
 
         return merge(mCexs), mdinvs
 
+    def test_cexs(self, loc, cexs, invs):
+        """
+        Return the invs at loc violated by cexs (models of the symstates)
+        using concrete evaluation (see RelInv.test_traces) instead of
+        the solver, i.e., these invs are disproved by cexs.
+        """
+        invs = [inv for inv in invs
+                if isinstance(inv, data.inv.base.RelInv)]
+        if not invs or not cexs:
+            return []
+
+        traces = data.traces.Traces(
+            [data.traces.Trace.fromDict(cex) for cex in cexs])
+        traces = traces.padzeros(set(self.inv_decls[loc].names))
+        rs = data.inv.base.RelInv.test_traces(invs, traces)
+        invs = [inv for inv, r in zip(invs, rs) if r is False]
+        if invs:
+            mlog.debug("{}: {} invs disproved by cexs".format(loc, len(invs)))
+        return invs
+
+    def get_cost(self, loc):
+        """
+        Relative cost of a solver call on the symstates at loc,
+        i.e., the number of path conditions over all depths
+        """
+        return max(1, sum(len(pcs) for pcs in self[loc].values()))
+
+    @staticmethod
+    def mk_batches(tasks):
+        """
+        Group (loc, inv) tasks into (loc, invs) batches,
+        with at most one batch per cpu for each loc
+        """
+        n_cpus = multiprocessing.cpu_count() if settings.DO_MP else 1
+        d = defaultdict(list)
+        for loc, inv in tasks:
+            d[loc].append(inv)
+
+        batches = []
+        for loc, invs in d.items():
+            n = min(n_cpus, len(invs))
+            batches.extend((loc, invs[i::n]) for i in range(n))
+        return batches
+
+    def bcheck_d(self, loc, invs, inps):
+        """
+        Check invs at loc together (ncexs = 1),
+        return [(loc, str(inv), (cexs, is_succ))] like mcheck_d
+        """
+        assert isinstance(loc, str), loc
+        assert isinstance(invs, list) and invs, invs
+
+        rs = {}
+        exprs = {}
+        for inv in invs:
+            try:
+                inv_expr = inv.expr(self.use_reals)
+            except AttributeError:
+                inv_expr = None
+            if inv_expr is None or inv_expr is zFalse:
+                rs[str(inv)] = self.mcheck_d(loc, inv, inps, ncexs=1)
+            else:
+                exprs[str(inv)] = inv_expr
+
+        if settings.DO_INCR_DEPTH:
+            depths = sorted(self[loc])
+        else:
+            depths = [None]
+
+        cexs, stats, sdepths = {}, {}, {}
+        for depth in depths:
+            todo = {k: exprs[k] for k in exprs if k not in cexs}
+            if not todo:
+                break
+            cexs_, stats_ = self.bcheck(
+                self.get_solver(loc, depth, False), todo, inps)
+
+            # like mcheck_depth, record stat changes across depths
+            if depth is not None:
+                for k in todo:
+                    stat_ = stats_[k]
+                    if k not in stats:
+                        if stat_ != z3.unsat:  # disproved or unknown first
+                            self.put_solver_stats(analysis.CheckDepthChanges(
+                                k, None, None, stat_, depth))
+                    elif stat_ != stats[k]:
+                        mlog.debug("check depth diff {}: {} @ depth {}, "
+                                   "{} @ depth {}".format(
+                                       k, stats[k], sdepths[k], stat_, depth))
+                        self.put_solver_stats(analysis.CheckDepthChanges(
+                            k, stats[k], sdepths[k], stat_, depth))
+                    sdepths[k] = depth
+
+            cexs.update(cexs_)
+            stats.update(stats_)
+
+        for k in exprs:
+            if k in cexs:
+                rs[k] = ([cexs[k]], True)
+            else:
+                rs[k] = (set(), stats[k] != z3.unknown)
+
+        return [(loc, str(inv), rs[str(inv)]) for inv in invs]
+
+    def bcheck(self, solver, exprs, inps):
+        """
+        Check exprs (name -> expr) in one session on solver.
+        Each expr gets a guard literal g => not(expr), and the solver is
+        repeatedly asked for a model satisfying a guard of the unresolved
+        exprs. A model disproves all exprs it violates and unsat proves
+        all remaining ones. If the solver gives up (unknown), the
+        remaining exprs are checked separately.
+        Return cexs (name -> cex) and stats (name -> z3 stat)
+        """
+        assert isinstance(solver, z3.Solver), solver
+        assert exprs, exprs
+
+        prefix = "_dig_guard_"
+        cexs, stats = {}, {}
+        solver.push()
+        try:
+            iconstr = self.get_inp_constrs(inps)
+            if iconstr is not None:
+                solver.add(iconstr)
+
+            guards = {}
+            for i, k in enumerate(exprs):
+                guards[k] = z3.Bool("{}{}".format(prefix, i))
+                solver.add(z3.Implies(guards[k], z3.Not(exprs[k])))
+
+            todo = list(exprs)
+            rnd = 0
+            while todo:
+                # fresh literal activating the disjunction of this round
+                r = z3.Bool("{}r{}".format(prefix, rnd))
+                rnd += 1
+                solver.add(z3.Implies(r, z3.Or([guards[k] for k in todo])))
+                stat = solver.check(r)
+                self.put_solver_stats(analysis.CheckSolverCalls(stat))
+
+                if stat == z3.unsat or (stat == z3.unknown and len(todo) == 1):
+                    for k in todo:
+                        stats[k] = stat
+                    break
+
+                if stat == z3.unknown:
+                    for k in todo:
+                        models, stat = helpers.miscs.Z3.get_models(
+                            z3.Not(exprs[k]), 1, solver=solver)
+                        self.put_solver_stats(analysis.CheckSolverCalls(stat))
+                        if models:
+                            cexs[k] = self.get_cex(models[0], prefix)
+                        stats[k] = stat
+                    break
+
+                m = solver.model()
+                cex = self.get_cex(m, prefix)
+                disproved = [k for k in todo
+                             if z3.is_true(m.eval(guards[k], True)) or
+                             z3.is_false(m.eval(exprs[k], True))]
+                assert disproved, m
+                for k in disproved:
+                    cexs[k] = cex
+                    stats[k] = stat
+                todo = [k for k in todo if k not in cexs]
+        finally:
+            solver.pop()
+
+        return cexs, stats
+
+    @staticmethod
+    def get_cex(model, prefix):
+        return {str(s): sage.all.sage_eval(str(model[s])) for s in model
+                if not str(s).startswith(prefix)}
+
     def mcheck_d(self, loc, inv, inps, ncexs):
 
         assert isinstance(loc, str), loc
@@ -540,22 +1143,21 @@ class SymStates(dict):
 
         if settings.DO_INCR_DEPTH:
             cexs, is_succ = self.mcheck_depth(
-                self[loc], inv, inv_expr, inps, ncexs)
+                loc, inv, inv_expr, inps, ncexs)
         else:
             cexs, is_succ, stat = self.mcheck(
-                self.get_ss_at_depth(self[loc], depth=None),
-                inv_expr, inps, ncexs)
+                self.get_solver(loc, None, False), inv_expr, inps, ncexs)
 
         return cexs, is_succ
 
-    def mcheck_depth(self, ssd, inv, inv_expr, inps, ncexs):
+    def mcheck_depth(self, loc, inv, inv_expr, inps, ncexs):
         assert inv_expr is None or z3.is_expr(inv_expr), inv_expr
-        assert isinstance(ssd, SymStatesDepth), ssd  # self.ss[loc]
+        ssd = self[loc]
+        assert isinstance(ssd, SymStatesDepth), ssd
 
         def f(depth):
-            ss = ssd[depth]
-            ss = ss.mypc if inv_expr is None else ss.myexpr
-            cexs, is_succ, stat = self.mcheck(ss, inv_expr, inps, ncexs)
+            solver = self.get_solver(loc, depth, inv_expr is None)
+            cexs, is_succ, stat = self.mcheck(solver, inv_expr, inps, ncexs)
             self.put_solver_stats(analysis.CheckSolverCalls(stat))
             return cexs, is_succ, stat
 
@@ -583,34 +1185,86 @@ class SymStates(dict):
 
         return cexs, is_succ
 
-    def mcheck(self, symstates_expr, expr, inps, ncexs):
+    def mcheck(self, solver, expr, inps, ncexs):
         """
-        check if pathcond => expr
+        check if pathcond => expr, where the pathcond (symstates)
+        are asserted in solver (see get_solver)
         if not, return cex
         return cexs, is_succ (if the solver does not timeout)
         """
-        assert z3.is_expr(symstates_expr), symstates_expr
+        assert isinstance(solver, z3.Solver), solver
         assert expr is None or z3.is_expr(expr), expr
         assert inps is None or isinstance(inps, data.traces.Inps), inps
         assert ncexs >= 0, ncexs
         # assert self.check_check_mode(check_mode), check_mode
 
-        f = symstates_expr
+        fs = []
         iconstr = self.get_inp_constrs(inps)
         if iconstr is not None:
-            f = z3.simplify(z3.And(iconstr, f))
+            fs.append(iconstr)
 
         if expr is not None:
-            f = z3.Not(z3.Implies(f, expr))
+            fs.append(z3.Not(expr))
 
-        models, stat = helpers.miscs.Z3.get_models(f, ncexs)
+        f = z3.And(fs) if fs else zTrue
+        models, stat = helpers.miscs.Z3.get_models(f, ncexs, solver=solver)
         cexs, is_succ = helpers.miscs.Z3.extract(models)
         return cexs, is_succ, stat
 
+    # Check upperbound of term using symbolic states
+    def check_upper(self, loc, term_expr, v, extra_constr=None):
+        """
+        Check if term_expr <= v holds at all symstates of loc.
+        Return (stat, depth, cexv), where stat is
+        unsat if it holds, sat if a symstate at depth has term_expr = cexv > v,
+        and unknown otherwise.
+        Like maximize, stat is None if no symstate at the first depth
+        satisfies extra_constr (there is no upperbound).
+        """
+        assert z3.is_expr(term_expr), term_expr
+        assert extra_constr is None or \
+            z3.is_expr(extra_constr), extra_constr
+
+        v = self.to_zval(v)
+        depths = sorted(self[loc]) if settings.DO_INCR_DEPTH else [None]
+        for depth in depths:
+            solver = self.get_solver(loc, depth, False)
+            solver.push()
+            try:
+                if extra_constr is not None:
+                    solver.add(extra_constr)
+                    if depth == depths[0]:
+                        stat = solver.check()
+                        self.put_solver_stats(
+                            analysis.CheckSolverCalls(stat))
+                        if stat == z3.unsat:
+                            return None, depth, None
+                solver.add(term_expr > v)
+                stat = solver.check()
+                self.put_solver_stats(analysis.CheckSolverCalls(stat))
+                if stat == z3.sat:
+                    cexv = solver.model().eval(term_expr, True)
+                    if z3.is_int_value(cexv):
+                        cexv = cexv.as_long()
+                    elif z3.is_rational_value(cexv):
+                        cexv = Fraction(cexv.numerator_as_long(),
+                                        cexv.denominator_as_long())
+                    else:
+                        cexv = None
+                    return stat, depth, cexv
+                elif stat == z3.unknown:
+                    return stat, depth, None
+            finally:
+                solver.pop()
+
+        return z3.unsat, None, None
+
     # Find maximal values for term using symbolic states
-    def maximize(self, loc, term_expr, extra_constr=None):
+    def maximize(self, loc, term_expr, extra_constr=None, lower=None):
         """
         maximize value of term
+        lower = (depth, v) means term_expr >= v at some symstate at depth
+        (see check_upper), which helps the optimizer
         """
         assert z3.is_expr(term_expr), term_expr
         assert extra_constr is None or \
@@ -618,14 +1272,20 @@ class SymStates(dict):
 
         if settings.DO_INCR_DEPTH:
             v, stat = self.mmaximize_depth(
-                self[loc], term_expr, extra_constr)
+                self[loc], term_expr, extra_constr, lower)
         else:
-            v, stat = self.mmaximize(
-                self.get_ss_at_depth(self[loc], depth=None),
-                term_expr)
+            ss = self.get_ss_at_depth(self[loc], depth=None)
+            if lower is not None:
+                ss = z3.And(ss, term_expr >= self.to_zval(lower[1]))
+            v, stat = self.mmaximize(ss, term_expr)
         return v
 
-    def mmaximize_depth(self, ssd, term_expr, extra_constr):
+    @staticmethod
+    def to_zval(v):
+        v = helpers.miscs.Miscs.to_pynum(v)
+        return z3.IntVal(v) if isinstance(v, int) else z3.RealVal(str(v))
+
+    def mmaximize_depth(self, ssd, term_expr, extra_constr, lower=None):
         assert isinstance(ssd, SymStatesDepth), ssd
         assert z3.is_expr(term_expr), term_expr
         assert extra_constr is None or \
@@ -635,6 +1295,9 @@ class SymStates(dict):
             ss = self.get_ss_at_depth(ssd, depth=depth)
             if extra_constr is not None:
                 ss = z3.And(ss, extra_constr)
+            # the states up to depth include the one having the lower value
+            if lower is not None and depth >= lower[0]:
+                ss = z3.And(ss, term_expr >= self.to_zval(lower[1]))
             maxv, stat = self.mmaximize(ss, term_expr)
             self.put_solver_stats(analysis.MaxSolverCalls(stat))
             return maxv, stat
@@ -676,16 +1339,118 @@ class SymStates(dict):
         opt.add(ss)
         h = opt.maximize(term_expr)
         stat = opt.check()
-        v = None
         if stat == z3.sat:
-            v = str(opt.upper(h))
-            if v != 'oo':  # no bound
-                v = int(v)
-                if v <= settings.IUPPER:
-                    return v, stat
+            return self.get_upper(opt, h), stat
 
         return None, stat
 
+    @staticmethod
+    def get_upper(opt, h):
+        v = str(opt.upper(h))
+        if v != 'oo':  # no bound
+            v = int(v)
+            if v <= settings.IUPPER:
+                return v
+        return None
+
+    # Find maximal values for several terms in one optimizer (box mode)
+    def maximize_terms(self, loc, term_exprs, extra_constr=None):
+        """
+        maximize values of terms independently, like maximize for each term
+        """
+        assert isinstance(term_exprs, list) and term_exprs, term_exprs
+        assert all(z3.is_expr(e) for e in term_exprs), term_exprs
+        assert extra_constr is None or \
+            z3.is_expr(extra_constr), extra_constr
+
+        if settings.DO_INCR_DEPTH:
+            vs = self.mmaximize_depth_terms(
+                self[loc], term_exprs, extra_constr)
+        else:
+            vs, _ = self.mmaximize_terms(
+                self.get_ss_at_depth(self[loc], depth=None), term_exprs)
+        return vs
+
+    def mmaximize_depth_terms(self, ssd, term_exprs, extra_constr):
+        """
+        Like mmaximize_depth for each term, but the terms that still have
+        upperbounds are maximized together at each depth
+        """
+        assert isinstance(ssd, SymStatesDepth), ssd
+
+        depths = sorted(ssd.keys())
+        maxvs = [None] * len(term_exprs)
+        idxs = list(range(len(term_exprs)))
+        for i, depth in enumerate(depths):
+            ss = self.get_ss_at_depth(ssd, depth=depth)
+            if extra_constr is not None:
+                ss = z3.And(ss, extra_constr)
+            vs, stats = self.mmaximize_terms(
+                ss, [term_exprs[j] for j in idxs])
+
+            for j, maxv_, stat_ in zip(idxs, vs, stats):
+                term_expr = term_exprs[j]
+                if i == 0:
+                    if maxv_ is None:  # no solution (unsat) or unknown
+                        self.put_solver_stats(analysis.MaxDepthChanges(
+                            str(term_expr), None, None, maxv_, depth))
+                elif maxv_ != maxvs[j]:
+                    maxv = maxvs[j]
+                    assert(not(isinstance(maxv_, int) and
+                               isinstance(maxv, int))
+                           or (maxv_ > maxv)), (maxv_, maxv)
+                    mlog.debug("maximize depth diff {}: {} @ depth {}, "
+                               "{} {} @ depth {}"
+                               .format(term_expr, maxv, depths[i-1],
+                                       maxv_, stat_, depth))
+                    self.put_solver_stats(analysis.MaxDepthChanges(
+                        str(term_expr), maxv, depths[i-1], maxv_, depth))
+                maxvs[j] = maxv_
+
+            idxs = [j for j in idxs if maxvs[j] is not None]
+            if not idxs:
+                break
+
+        return maxvs
+
+    def mmaximize_terms(self, ss, term_exprs):
+        """
+        Maximize terms as independent objectives (box priority)
+        over the same symstates in one optimizer.
+        If the optimizer gives up, maximize each term separately.
+        """
+        assert z3.is_expr(ss), ss
+        assert term_exprs, term_exprs
+
+        if len(term_exprs) == 1:
+            v, stat = self.mmaximize(ss, term_exprs[0])
+            self.put_solver_stats(analysis.MaxSolverCalls(stat))
+            return [v], [stat]
+
+        opt = helpers.miscs.Z3.create_solver(maximize=True)
+        opt.set(priority='box')
+        opt.add(ss)
+        hs = [opt.maximize(term_expr) for term_expr in term_exprs]
+        stat = opt.check()
+        self.put_solver_stats(analysis.MaxSolverCalls(stat))
+
+        if stat == z3.unknown:
+            mlog.debug("box optimization of {} terms: unknown, "
+                       "maximize them separately".format(len(term_exprs)))
+            vs, stats = [], []
+            for term_expr in term_exprs:
+                v, stat = self.mmaximize(ss, term_expr)
+                self.put_solver_stats(analysis.MaxSolverCalls(stat))
+                vs.append(v)
+                stats.append(stat)
+            return vs, stats
+
+        if stat == z3.sat:
+            vs = [self.get_upper(opt, h) for h in hs]
+        else:
+            vs = [None] * len(hs)
+        return vs, [stat] * len(hs)
+
     # helpers
 
     def get_ss_at_depth(self, ssd, depth=None):
@@ -1,7 +1,9 @@
 import pdb
 from collections import namedtuple
+from fractions import Fraction
 from pathlib import Path
 
+import numpy
 import z3
 import sage.all
 
@@ -100,6 +102,19 @@ class Trace(SymbsVals):
 
 
 class Traces(SymbsValsSet):
+    """
+    Set of traces, e.g., at a location.
+
+    The trace values are also kept column-wise, i.e., as one numpy array
+    per symbol (one entry per trace, in the order of self.rows), so that
+    evaluating expressions over all traces are done by array operations.
+    The columns are built lazily, extended (not rebuilt) when new traces
+    are added, and dropped when traces are removed.
+    """
+
+    # ints above this are stored as Python ints (object arrays)
+    # to avoid int64 overflows
+    max_int64 = 2**62
 
     def __str__(self, printDetails=False):
         if printDetails:
@@ -107,13 +122,241 @@ class Traces(SymbsValsSet):
         else:
             return str(len(self))
 
+    def add(self, t):
+        assert isinstance(t, SymbsVals), t
+        not_in = t not in self
+        if not_in:
+            rows = self.rows
+            super().add(t)
+            rows.append(t)
+        return not_in
+
+    # other mutators reset the columns
+    def _reset(self):
+        for k in ('_rows', '_cols', '_masks'):
+            self.__dict__.pop(k, None)
+
+    def remove(self, t):
+        super().remove(t)
+        self._reset()
+
+    def discard(self, t):
+        super().discard(t)
+        self._reset()
+
+    def pop(self):
+        t = super().pop()
+        self._reset()
+        return t
+
+    def clear(self):
+        super().clear()
+        self._reset()
+
+    def update(self, *ts):
+        super().update(*ts)
+        self._reset()
+
+    def difference_update(self, *ts):
+        super().difference_update(*ts)
+        self._reset()
+
+    def intersection_update(self, *ts):
+        super().intersection_update(*ts)
+        self._reset()
+
+    def symmetric_difference_update(self, ts):
+        super().symmetric_difference_update(ts)
+        self._reset()
+
+    def __ior__(self, ts):
+        self.update(ts)
+        return self
+
+    def __iand__(self, ts):
+        self.intersection_update(ts)
+        return self
+
+    def __isub__(self, ts):
+        self.difference_update(ts)
+        return self
+
+    def __ixor__(self, ts):
+        self.symmetric_difference_update(ts)
+        return self
+
+    @property
+    def rows(self):
+        """
+        traces in the order of the entries of the columns
+        """
+        try:
+            return self._rows
+        except AttributeError:
+            self._rows = list(super().__iter__())
+            return self._rows
+
+    def col(self, s):
+        """
+        Return the values of symbol s over all traces (see self.rows)
+        """
+        try:
+            cols = self._cols
+        except AttributeError:
+            cols = self._cols = {}
+
+        rows = self.rows
+        c = cols.get(s)
+        n = 0 if c is None else len(c)
+        if n < len(rows):
+            new_c = self._mk_array(
+                [[Miscs.to_pynum(t.vs[t.ss.index(s)])] for t in rows[n:]], 1)
+            new_c = new_c.reshape(len(new_c))
+            c = new_c if c is None else numpy.concatenate((c, new_c))
+            cols[s] = c
+        return c
+
+    def mat(self, ss):
+        """
+        Return the values of symbols ss as a (new) matrix,
+        one row per trace (see self.rows) and one column per symbol
+        """
+        if not ss:
+            return numpy.empty((len(self.rows), 0), dtype=numpy.int64)
+        return numpy.column_stack([self.col(s) for s in ss])
+
+    @property
+    def large_mask(self):
+        """
+        traces (rows) having extremely large values, e.g., 435848050 (geo1),
+        which are ignored when testing invs
+        """
+        return self._get_mask(
+            'large', lambda t: any(v > t.max_val for v in t.vs))
+
+    @property
+    def reprat_mask(self):
+        """
+        traces (rows) having repeating rationals, e.g., 1/3,
+        which are ignored when testing eqts
+        """
+        def f(t):
+            vs = (Miscs.to_pynum(v) for v in t.vs)
+            return any(isinstance(v, Fraction) and
+                       Miscs.is_repeating_rational(Miscs.to_sagenum(v))
+                       for v in vs)
+        return self._get_mask('reprat', f)
+
+    def _get_mask(self, key, f):
+        try:
+            masks = self._masks
+        except AttributeError:
+            masks = self._masks = {}
+
+        rows = self.rows
+        m = masks.get(key, numpy.zeros(0, dtype=bool))
+        if len(m) < len(rows):
+            new_m = numpy.array([f(t) for t in rows[len(m):]], dtype=bool)
+            m = numpy.concatenate((m, new_m))
+            masks[key] = m
+        return m
+
+    def eval_monomials(self, ss, exps):
+        """
+        Return the values of monomials over all traces as a matrix,
+        one row per trace and one column per monomial.
+        Each monomial is a tuple of exponents of symbols ss,
+        e.g., (2, 0, 1) is x^2*z for ss = (x, y, z)
+        """
+        assert all(len(es) == len(ss) for es in exps), (ss, exps)
+
+        m = self.mat(ss)
+        maxs = self._get_maxs(m)
+        cols = []
+        for es in exps:
+            bound = 1
+            for mx, e in zip(maxs, es):
+                bound *= mx ** e
+            if m.dtype != object and bound < self.max_int64:
+                col, m_ = numpy.ones(len(m), dtype=numpy.int64), m
+            else:
+                col, m_ = numpy.ones(len(m), dtype=object), m.astype(object)
+
+            for j, e in enumerate(es):
+                if e:
+                    col = col * m_[:, j] ** e
+            cols.append(col)
+
+        if not cols:
+            return numpy.empty((len(m), 0), dtype=numpy.int64)
+        return numpy.column_stack(cols)
+
+    def eval_poly(self, p):
+        """
+        Evaluate polynomial p over all traces (in self.rows order)
+        Return None if p is not a polynomial (e.g., sqrt(x))
+        """
+        monos = Miscs.get_monomials(p)
+        if monos is None:
+            return None
+
+        ss = tuple(sorted(set(s for _, mono in monos for s, _ in mono)))
+        exps = [tuple(dict(mono).get(s, 0) for s in ss) for _, mono in monos]
+        coefs = [c for c, _ in monos]
+        return self.mydot(self.eval_monomials(ss, exps), coefs)
+
     def myeval(self, expr, pred=None):
         assert Miscs.is_expr(expr), expr
 
+        vs = self.eval_poly(expr)
+        if vs is None:  # cannot vectorize, so eval each trace
+            vs = (trace.myeval(expr) for trace in self)
+        else:
+            vs = (Miscs.to_sagenum(v) for v in vs)
+
         if pred is None:
-            return [trace.myeval(expr) for trace in self]
+            return list(vs)
         else:
-            return any(pred(trace.myeval(expr)) for trace in self)
+            return any(pred(v) for v in vs)
+
+    @classmethod
+    def mydot(cls, m, coefs):
+        """
+        Return m * coefs exactly, i.e., using int64 only when
+        it does not overflow.
+        coefs is a vector or a matrix (one column per vector)
+        """
+        cs = numpy.array(coefs, dtype=object)
+        assert m.ndim == 2 and m.shape[1] == cs.shape[0], (m.shape, cs.shape)
+
+        if not len(cs):
+            return numpy.zeros((len(m),) + cs.shape[1:], dtype=numpy.int64)
+        elif (m.dtype != object and
+                all(isinstance(c, int) for c in cs.flat) and
+                max(cls._get_maxs(m), default=0) *
+                max(cls._get_maxs(cs.reshape(len(cs), -1).T), default=0) *
+                len(cs) < cls.max_int64):
+            return m.dot(cs.astype(numpy.int64))
+        else:
+            return m.astype(object).dot(cs)
+
+    @classmethod
+    def _mk_array(cls, vss, ncols):
+        if all(isinstance(v, int) and abs(v) < cls.max_int64
+               for vs in vss for v in vs):
+            dtype = numpy.int64
+        else:
+            dtype = object
+        return numpy.array(vss, dtype=dtype).reshape(len(vss), ncols)
+
+    @staticmethod
+    def _get_maxs(m):
+        """
+        max absolute values (as Python nums) of columns of m
+        """
+        if not len(m):
+            return [0] * m.shape[1]
+        return [abs(v) for v in numpy.abs(m).max(axis=0).tolist()]
 
     @classmethod
     def extract(cls, cexs, useOne=True):
@@ -135,28 +378,35 @@ class Traces(SymbsValsSet):
     def mydicts(self):
         return (trace.mydict for trace in self)
 
-    def instantiate(self, term, ntraces):
-        assert Miscs.is_expr(term), term
+    def instantiate(self, terms, ntraces):
+        """
+        Return the values of terms (monomials) over traces as a set of
+        rows, each row is an equation over the terms' unknown coefs.
+
+        If ntraces is given, return at most ntraces rows, preferring
+        those with fewer nonzeros (the more 0's the better).
+        """
+        assert isinstance(terms, list) and terms, terms
         assert ntraces is None or ntraces >= 1, ntraces
 
+        ss, exps = Miscs.get_term_exps(tuple(terms))
+        vals = self.eval_monomials(ss, exps)
+        nzs = (vals != 0).sum(axis=1).tolist()
+
+        # dedup rows, keep the first occurrence (and its nonzeros count)
+        rows = {}
+        for row, nz in zip(map(tuple, vals.tolist()), nzs):
+            if row not in rows:
+                rows[row] = nz
+                if (ntraces is not None and
+                        len(rows) >= ntraces * settings.TRACE_MULTIPLIER):
+                    break
+
         if ntraces is None:
-            for t in self.mydicts:
-                exprs = set(term.subs(t) for t in self.mydicts)
-        else:
-            ntracesExtra = ntraces * settings.TRACE_MULTIPLIER
-            exprs = set()
-            for t in self.mydicts:
-                expr = term.subs(t)
-                if expr not in exprs:
-                    exprs.add(expr)
-                    if len(exprs) >= ntracesExtra:
-                        break
-
-            # instead of doing this, can find out the # 0's in traces
-            # the more 0's , the better
-            exprs = sorted(exprs, key=lambda expr: len(Miscs.get_vars(expr)))
-            exprs = set(exprs[:ntraces])
-        return exprs
+            return set(rows)
+
+        rows = sorted(rows, key=lambda row: rows[row])
+        return set(rows[:ntraces])
 
     def padzeros(self, ss):
         new_traces = Traces()
@@ -191,10 +441,7 @@ class DTraces(dict):
         if loc not in self:
             self[loc] = Traces()
 
-        not_in = trace not in self[loc]
-        if not_in:
-            self[loc].add(trace)
-        return not_in
+        return self[loc].add(trace)
 
     def merge(self, new_traces):
         """
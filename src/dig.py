@@ -88,6 +88,10 @@ if __name__ == "__main__":
        action="store_true",
        help="don't use incremental depth")
 
+    ag("--nosscache", "-nosscache",
+       action="store_true",
+       help="don't use cached symbolic states (from previous runs)")
+
     ag("--nosimplify", "-nosimplify",
        action="store_true",
        help="don't simplify invariants, e.g., don't remove weaker invariants")
@@ -0,0 +1,423 @@
+"""
+Exact linear algebra over QQ for equation solving,
+e.g., computing the kernel of the matrix of term values over traces
+"""
+import math
+import pdb
+from fractions import Fraction
+
+import numpy
+
+import helpers.vcommon as CM
+import settings
+
+DBG = pdb.set_trace
+mlog = CM.getLogger(__name__, settings.logger_level)
+
+
+def _is_prime(n):
+    """
+    Deterministic Miller-Rabin for n < 3215031751
+
+    >>> [n for n in range(20) if _is_prime(n)]
+    [2, 3, 5, 7, 11, 13, 17, 19]
+    >>> _is_prime(2147483647)
+    True
+    """
+    if n < 2:
+        return False
+    for p in (2, 3, 5, 7):
+        if n % p == 0:
+            return n == p
+
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d, s = d // 2, s + 1
+
+    for a in (2, 3, 5, 7):
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def _isqrt(n):
+    """
+    >>> [_isqrt(n) for n in (0, 1, 8, 9, 10**40)]
+    [0, 1, 2, 3, 100000000000000000000]
+    """
+    if n < 2:
+        return n
+    x = 1 << ((n.bit_length() + 1) // 2)
+    while True:
+        y = (x + n // x) // 2
+        if y >= x:
+            return x
+        x = y
+
+
+class Primes:
+    """
+    Primes < 2^31, so that products of two residues fit in int64
+    """
+    _primes = []
+
+    @classmethod
+    def get(cls, i):
+        while len(cls._primes) <= i:
+            p = cls._primes[-1] if cls._primes else 2**31
+            p -= 1
+            while not _is_prime(p):
+                p -= 1
+            cls._primes.append(p)
+        return cls._primes[i]
+
+
+class Kernel:
+    """
+    Right kernel (nullspace) of a matrix over QQ.
+
+    The rref is computed modulo several word-size primes (using numpy),
+    combined with CRT, and the kernel basis is obtained by rational
+    reconstruction and then verified exactly over ZZ.
+    Optionally, a float64 probe first removes columns that do not seem
+    to occur in the kernel (the exact kernel is recomputed on all columns
+    if it is then smaller than the probed one),
+    and skips the exact computation for full rank matrices.
+
+    The basis is the "pivot" basis, i.e., each vector has a 1 at one
+    free (non-pivot) column and 0 at the others, which is what solving
+    the equations and setting each free parameter to 1 gives.
+    Basis vectors are returned as primitive integer vectors.
+
+    >>> Kernel([(1, 2, 3), (2, 4, 6)], 3).basis
+    [(-2, 1, 0), (-3, 0, 1)]
+    >>> Kernel([(1, 0, -1), (0, 1, -1)], 3).basis
+    [(1, 1, 1)]
+    >>> Kernel([(1, 1), (1, 2)], 2).basis
+    []
+    >>> Kernel([(Fraction(1, 2), Fraction(-1, 3))], 2).basis
+    [(2, 3)]
+    >>> Kernel([(0, 0)], 2).basis
+    [(1, 0), (0, 1)]
+    >>> Kernel([(1, 0, 5), (2, 0, 7), (3, 0, 1)], 3, probe=True).basis
+    [(0, 1, 0)]
+    """
+
+    MAX_PRIMES = 200
+    PROBE_RTOL = 1e-9  # singular values below this (relative) are zeros
+    PROBE_CTOL = 1e-6  # smaller entries (relative) of kernel vectors are zeros
+
+    def __init__(self, rows, ncols, probe=False):
+        assert ncols >= 1, ncols
+        assert all(len(row) == ncols for row in rows), rows
+
+        self.ncols = ncols
+        self.rows = [self.to_ints(row) for row in rows]
+        self.rows = [row for row in self.rows if any(row)]
+
+        cols, nullity = list(range(ncols)), None
+        if probe and self.rows:
+            cols, nullity = self.probe(self.rows, ncols)
+            mlog.debug("probe: {} of {} cols, nullity {}".format(
+                len(cols), ncols, nullity))
+
+        if not cols:  # full rank
+            self.pivots, self.basis = list(range(ncols)), []
+            return
+
+        pivots, basis = self._compute_cols(self.rows, ncols, cols)
+        if nullity is not None and len(basis) < nullity:
+            # the pruned cols missed some kernel vectors, e.g., with a
+            # small coef next to large ones, so solve without pruning
+            mlog.debug("probe: kernel dim {} < nullity {}, use all cols"
+                       .format(len(basis), nullity))
+            cols = list(range(ncols))
+            pivots, basis = self._compute_cols(self.rows, ncols, cols)
+        self.pivots, self.basis = pivots, basis
+
+    @classmethod
+    def _compute_cols(cls, rows, ncols, cols):
+        """
+        Compute the kernel using only cols (the other entries are 0)
+        """
+        rows = [tuple(row[c] for c in cols) for row in rows]
+        rows = [row for row in rows if any(row)]
+        pivots, basis = cls._compute(rows, len(cols))
+        pivots = [cols[c] for c in pivots]
+        if len(cols) < ncols:
+            vs = []
+            for v in basis:
+                v_ = [0] * ncols
+                for c, a in zip(cols, v):
+                    v_[c] = a
+                vs.append(tuple(v_))
+            basis = vs
+        return pivots, basis
+
+    @property
+    def dim(self):
+        return len(self.basis)
+
+    def add_rows(self, rows):
+        """
+        Shrink the kernel using new rows, i.e., the new kernel is the
+        subspace of the current one orthogonal to the rows.
+        Each row costs O(dim * ncols), no refactoring is needed.
+        The basis is kept primitive but is no longer the pivot basis
+        (and self.pivots is not updated).
+        Return the number of rows that changed the kernel.
+
+        >>> k = Kernel([(1, 2, 3, 4)], 4)
+        >>> k.dim
+        3
+        >>> k.add_rows([(2, 4, 6, 8), (0, 1, 0, -1)])
+        1
+        >>> k.basis
+        [(-3, 0, 1, 0), (-6, 1, 0, 1)]
+        >>> k.add_rows([(1, 0, 0, 0)])
+        1
+        >>> k.basis
+        [(0, -1, 2, -1)]
+        """
+        assert all(len(row) == self.ncols for row in rows), rows
+
+        nchanges = 0
+        for row in rows:
+            row = self.to_ints(row)
+            if not any(row):
+                continue
+            self.rows.append(row)
+
+            cs = [sum(a * b for a, b in zip(v, row) if a) for v in self.basis]
+            js = [j for j, c in enumerate(cs) if c]
+            if not js:
+                continue
+
+            # eliminate using the sparsest vector
+            j = min(js, key=lambda j: sum(1 for a in self.basis[j] if a))
+            vj, cj = self.basis[j], cs[j]
+            basis = []
+            for i, (vi, ci) in enumerate(zip(self.basis, cs)):
+                if i == j:
+                    continue
+                if ci:
+                    vi = self.to_ints(
+                        [cj * a - ci * b for a, b in zip(vi, vj)])
+                basis.append(vi)
+            self.basis = basis
+            nchanges += 1
+
+        return nchanges
+
+    @staticmethod
+    def to_ints(row):
+        """
+        scale (rational) row to a primitive integer row
+
+        >>> Kernel.to_ints((Fraction(1, 2), 3, Fraction(-3, 4)))
+        (2, 12, -3)
+        >>> Kernel.to_ints((0, -6, 4))
+        (0, -3, 2)
+        """
+        denom = 1
+        for v in row:
+            d = Fraction(v).denominator
+            denom = denom * d // math.gcd(denom, d)
+        row = [int(Fraction(v) * denom) for v in row]
+
+        g = 0
+        for v in row:
+            g = math.gcd(g, v)
+        if g > 1:
+            row = [v // g for v in row]
+        return tuple(row)
+
+    @classmethod
+    def rref_mod(cls, m, p):
+        """
+        Return the (nonzero rows of the) rref of int64 matrix m mod p
+        and its pivot columns
+        """
+        m = m.copy()
+        nrows, ncols = m.shape
+        pivots = []
+        r = 0
+        for c in range(ncols):
+            if r == nrows:
+                break
+            nzs = numpy.nonzero(m[r:, c])[0]
+            if not len(nzs):
+                continue
+
+            i = r + nzs[0]
+            if i != r:
+                m[[r, i]] = m[[i, r]]
+            m[r] = m[r] * pow(int(m[r, c]), p - 2, p) % p
+
+            col = m[:, c].copy()
+            col[r] = 0
+            nzs = numpy.nonzero(col)[0]
+            if len(nzs):
+                m[nzs] = (m[nzs] - numpy.outer(col[nzs], m[r]) % p) % p
+
+            pivots.append(c)
+            r += 1
+
+        return m[:r], pivots
+
+    @classmethod
+    def ratrecon(cls, a, m):
+        """
+        Rational reconstruction, i.e., find n/d = a mod m
+        with |n|, d <= sqrt(m/2). Return None if none exists.
+
+        >>> Kernel.ratrecon(-3 * pow(7, 1007, 1009) % 1009, 1009)
+        Fraction(-3, 7)
+        """
+        bound = _isqrt(m // 2)
+        r0, r1 = m, a % m
+        s0, s1 = 0, 1
+        while r1 > bound:
+            q = r0 // r1
+            r0, r1 = r1, r0 - q * r1
+            s0, s1 = s1, s0 - q * s1
+
+        if s1 == 0 or abs(s1) > bound or math.gcd(r1, abs(s1)) != 1:
+            return None
+        return Fraction(r1, s1)
+
+    @classmethod
+    def probe(cls, rows, ncols):
+        """
+        Estimate the kernel numerically (float64 svd) and return the
+        columns that look nonzero in some kernel vector, i.e., the
+        other columns (terms) can be removed before the exact solve,
+        and the estimated nullity (kernel dim).
+        Return ([], 0) if the matrix has full column rank.
+
+        The rank tolerance is loose, so that the nullity is not
+        underestimated. The columns can miss small coefs, so the caller
+        checks the exact kernel on them against the nullity.
+
+        >>> Kernel.probe([(1, 2, 3), (2, 4, 6)], 3)
+        ([0, 1, 2], 2)
+        >>> Kernel.probe([(1, 0, 5), (2, 0, 7), (3, 0, 1)], 3)
+        ([1], 1)
+        >>> Kernel.probe([(1, 1), (1, 2)], 2)
+        ([], 0)
+        >>> Kernel.probe([(1, x, x*x, 2*x + 3) for x in range(10)], 4)
+        ([0, 1, 3], 1)
+        """
+        cols = list(range(ncols))
+        try:
+            m = numpy.array([[float(v) for v in row] for row in rows],
+                            dtype=numpy.float64).reshape(len(rows), ncols)
+        except OverflowError:
+            return cols, None
+        if not numpy.isfinite(m).all():
+            return cols, None
+
+        # scaling columns does not change the zero pattern of the kernel
+        mx = numpy.abs(m).max(axis=0)
+        mx[mx == 0] = 1.0
+        m = m / mx
+
+        try:
+            _, svals, vt = numpy.linalg.svd(m)
+        except numpy.linalg.LinAlgError:
+            return cols, None
+
+        if not len(svals) or svals[0] == 0:
+            return cols, None
+        rank = int((svals > cls.PROBE_RTOL * svals[0]).sum())
+        ks = vt[rank:]
+        if not len(ks):
+            return [], 0
+
+        # an entry is nonzero if it is not small relative to its vector
+        ks = numpy.abs(ks)
+        nzs = ks > cls.PROBE_CTOL * ks.max(axis=1)[:, numpy.newaxis]
+        return [c for c in cols if nzs[:, c].any()], len(ks)
+
+    @classmethod
+    def _kernel_mod(cls, rows, ncols, p):
+        m = numpy.array(rows, dtype=object).reshape(len(rows), ncols) % p
+        r, pivots = cls.rref_mod(m.astype(numpy.int64), p)
+
+        frees = [c for c in range(ncols) if c not in set(pivots)]
+        vs = numpy.zeros((len(frees), ncols), dtype=numpy.int64)
+        for k, f in enumerate(frees):
+            vs[k, f] = 1
+            for i, c in enumerate(pivots):
+                vs[k, c] = -r[i, f] % p
+        return pivots, vs
+
+    @classmethod
+    def _reconstruct(cls, vs, mod):
+        basis = []
+        for v in vs:
+            v_ = []
+            for a in v:
+                x = cls.ratrecon(int(a), mod)
+                if x is None:
+                    return None
+                v_.append(x)
+            basis.append(cls.to_ints(v_))
+        return basis
+
+    @classmethod
+    def _verify(cls, rows, ncols, basis):
+        if not basis or not rows:
+            return True
+        m = numpy.array(rows, dtype=object).reshape(len(rows), ncols)
+        ks = numpy.array(basis, dtype=object).reshape(len(basis), ncols)
+        return not m.dot(ks.T).any()
+
+    @classmethod
+    def _compute(cls, rows, ncols):
+        if not rows:
+            basis = [tuple(int(i == j) for j in range(ncols))
+                     for i in range(ncols)]
+            return [], basis
+
+        pivots, vs, mod = None, None, None
+        for i in range(cls.MAX_PRIMES):
+            p = Primes.get(i)
+            pivots_, vs_ = cls._kernel_mod(rows, ncols, p)
+
+            if (pivots is None or len(pivots_) > len(pivots) or
+                    (len(pivots_) == len(pivots) and pivots_ < pivots)):
+                # first or better prime, (re)start
+                pivots, vs, mod = pivots_, vs_.astype(object), p
+            elif pivots_ != pivots:
+                mlog.debug("unlucky prime {}".format(p))
+                continue
+            else:
+                # combine using crt
+                inv = pow(mod % p, p - 2, p)
+                vs = vs + mod * ((vs_.astype(object) - vs) * inv % p)
+                mod = mod * p
+
+            if len(pivots) == ncols:  # full rank
+                return pivots, []
+
+            basis = cls._reconstruct(vs, mod)
+            if basis is not None and cls._verify(rows, ncols, basis):
+                mlog.debug("kernel dim {} ({} rows, {} cols, {} primes)"
+                           .format(len(basis), len(rows), ncols, i + 1))
+                return pivots, basis
+
+        raise ValueError("cannot compute kernel using {} primes"
+                         .format(cls.MAX_PRIMES))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
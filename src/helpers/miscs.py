@@ -1,17 +1,22 @@
 from functools import reduce
-from collections import defaultdict
+from collections import OrderedDict
+import os
 import pdb
 import itertools
 import operator
 import ast
-import multiprocessing
 from collections import Iterable
+from fractions import Fraction
 
+import numpy
 import sage.all
 from sage.all import cached_function, fork
+from cysignals.alarm import alarm, cancel_alarm, AlarmInterrupt
 
 import z3
 import helpers.vcommon as CM
+from helpers.linalg import Kernel
+import helpers.pool
 import settings
 
 DBG = pdb.set_trace
@@ -137,6 +142,69 @@ class Miscs(object):
 
         return sage.all.QQ(sage.all.RR(s))
 
+    @staticmethod
+    def to_pynum(x):
+        """
+        Convert a (Sage) number to a Python int or Fraction,
+        which are used in the numpy (object) matrices of traces
+
+        sage: from helpers.miscs import Miscs
+        sage: assert Miscs.to_pynum(QQ(6)/3) == 2
+        sage: assert isinstance(Miscs.to_pynum(QQ(6)/3), int)
+        sage: assert Miscs.to_pynum(-3/7) == Fraction(-3, 7)
+        """
+        if isinstance(x, int):
+            return x
+        f = Fraction(str(x))
+        return f.numerator if f.denominator == 1 else f
+
+    @staticmethod
+    def to_sagenum(x):
+        """
+        Convert a Python (or numpy) number back to Sage
+
+        sage: from helpers.miscs import Miscs
+        sage: assert Miscs.to_sagenum(Fraction(-3, 7)) == -3/7
+        sage: assert Miscs.to_sagenum(numpy.int64(7)).parent() == ZZ
+        """
+        if isinstance(x, Fraction):
+            return sage.all.QQ(x.numerator) / x.denominator
+        elif isinstance(x, (int, numpy.integer)):
+            return sage.all.Integer(int(x))
+        else:
+            return x
+
+    @classmethod
+    def get_monomials(cls, p):
+        """
+        Return the monomials of polynomial p as a list of
+        (coef, ((var, exp), ...)), or None if p is not a polynomial
+
+        sage: from helpers.miscs import Miscs
+        sage: var('x y')
+        (x, y)
+        sage: sorted(Miscs.get_monomials(3*x^2*y - 1/2*y + 7), key=str)
+        [(3, (('x', 2), ('y', 1))), (7, ()), (Fraction(-1, 2), (('y', 1),))]
+        sage: Miscs.get_monomials(x - 1/2*sqrt(y))
+        """
+        vs = cls.get_vars(p)
+        if not vs:
+            try:
+                return [(cls.to_pynum(sage.all.QQ(p)), ())]
+            except TypeError:
+                return None
+
+        try:
+            Q = sage.all.PolynomialRing(
+                sage.all.QQ, len(vs), list(map(str, vs)))
+            poly = Q(p)
+        except (TypeError, ValueError):
+            return None
+
+        names = Q.variable_names()
+        return [(cls.to_pynum(c), tuple((v, e) for v, e in zip(names, es) if e))
+                for es, c in poly.dict().items()]
+
     @classmethod
     def init_terms(cls, vs, deg, rate):
         assert vs, vs
@@ -144,10 +212,8 @@ class Miscs(object):
         assert rate >= 0.1, rate
 
         terms = cls.get_terms([sage.all.var(v) for v in vs], deg)
-
-        template, uks = cls.mk_template(terms, 0, retCoefVars=True)
-        n_eqts_needed = int(rate * len(uks))
-        return terms, template, uks, n_eqts_needed
+        n_eqts_needed = int(rate * len(terms))
+        return terms, n_eqts_needed
 
     @staticmethod
     def get_terms(ss, deg):
@@ -183,6 +249,24 @@ class Miscs(object):
         terms = [sage.all.prod(c) for c in combs]
         return terms
 
+    @staticmethod
+    @cached_function
+    def get_term_exps(terms):
+        """
+        Return the symbols and the exponents of the given monomials
+
+        sage: from helpers.miscs import Miscs
+        sage: Miscs.get_term_exps(tuple(Miscs.get_terms(list(var('a b')), 2)))
+        (('a', 'b'), ((0, 0), (1, 0), (0, 1), (2, 0), (1, 1), (0, 2)))
+        """
+        monos = [Miscs.get_monomials(t) for t in terms]
+        assert all(m and len(m) == 1 and m[0][0] == 1 for m in monos), terms
+
+        monos = [dict(m[0][1]) for m in monos]
+        ss = tuple(sorted(set(s for m in monos for s in m)))
+        exps = tuple(tuple(m.get(s, 0) for s in ss) for m in monos)
+        return ss, exps
+
     @classmethod
     def get_deg(cls, nvs, nts, max_deg=7):
         """
@@ -256,11 +340,16 @@ class Miscs(object):
 
         return set(rs)
 
-    @staticmethod
-    def reduce_eqts(ps):
+    @classmethod
+    def reduce_eqts(cls, ps):
         """
         Return the basis (e.g., a min subset of ps that implies ps)
-        of the set of eqts input ps using Groebner basis
+        of the set of eqts input ps.
+        Duplicated and linearly dependent eqts (over the monomials) are
+        removed first. If all eqts are linear, the basis is their rref,
+        i.e., the interreduced basis that Groebner basis would give.
+        Otherwise, the rest is reduced using Groebner basis, which is
+        given up after settings.GROEBNER_TIMEOUT secs.
 
         sage: from helpers.miscs import Miscs
 
@@ -276,25 +365,96 @@ class Miscs(object):
         # Attribute error occurs when only 1 var, thus return as is
         sage: rs =  Miscs.reduce_eqts([x*x==4,x==2])
         sage: assert set(rs) == set([x == 2, x^2 == 4])
+
+        sage: rs =  Miscs.reduce_eqts([x+y==2, 2*x+2*y==4, x-y==0, x==1])
+        sage: assert rs == [x - 1 == 0, y - 1 == 0]
         """
         if len(ps) <= 1:
             return ps
 
         assert (p.operator() == sage.all.operator.eq for p in ps), ps
+        ps, is_linear = cls.reduce_eqts_linear(ps)
+        if len(ps) <= 1 or is_linear:
+            return ps
+
         try:
+            alarm(settings.GROEBNER_TIMEOUT)
             Q = sage.all.PolynomialRing(sage.all.QQ, Miscs.get_vars(ps))
             myIdeal = Q*ps
-            ps = myIdeal.radical().interreduced_basis()
-            ps = [(sage.all.SR(p) == 0) for p in ps]
+            ps_ = myIdeal.radical().interreduced_basis()
+            ps = [(sage.all.SR(p) == 0) for p in ps_]
+        except AlarmInterrupt:
+            mlog.warning("reduce {} eqts: groebner timeout ({}s)".format(
+                len(ps), settings.GROEBNER_TIMEOUT))
         except AttributeError as ex:
             mlog.error(ex)
             pass
         except ValueError as ex:
             mlog.error(ex)
             pass
+        finally:
+            cancel_alarm()
 
         return ps
 
+    @classmethod
+    def reduce_eqts_linear(cls, ps):
+        """
+        Remove eqts in ps that are duplicates (up to scaling) or
+        linear combinations of the previous ones, where each
+        monomial is treated as a separate unknown.
+        Return the remaining eqts and whether they are all linear.
+        If they are, the remaining eqts are replaced by their rref
+        (monic rows ordered by leading variable, constants last),
+        which is the interreduced basis of the ideal they span.
+
+        sage: from helpers.miscs import Miscs
+        sage: var('x y')
+        (x, y)
+        sage: Miscs.reduce_eqts_linear([x*y==6, 2*x*y==12, x==3, x*y-x==3])
+        ([x*y == 6, x == 3], False)
+        sage: Miscs.reduce_eqts_linear([2*x+y==4, 4*x+2*y==8, y==2])
+        ([x - 1 == 0, y - 2 == 0], True)
+        """
+        monoss = [cls.get_monomials(p.lhs() - p.rhs()) for p in ps]
+        if any(monos is None for monos in monoss):
+            return ps, False
+
+        # higher degree monomials first, constant last
+        keys = set(mono for monos in monoss for _, mono in monos)
+        keys = sorted(keys, key=lambda m: (-sum(e for _, e in m), m))
+        is_linear = all(sum(e for _, e in m) <= 1 for m in keys)
+        cols = {m: c for c, m in enumerate(keys)}
+
+        kernel = Kernel([], len(keys))
+        seen = set()
+        ps_, rows = [], []
+        for p, monos in zip(ps, monoss):
+            row = [0] * len(keys)
+            for coef, mono in monos:
+                row[cols[mono]] = coef
+            row = Kernel.to_ints(row)
+            if not any(row):
+                continue
+            # normalize, e.g., -x + y and 2*x - 2*y are the same row
+            if next(a for a in row if a) < 0:
+                row = tuple(-a for a in row)
+            if row in seen:
+                continue
+            seen.add(row)
+            if kernel.add_rows([row]):
+                ps_.append(p)
+                rows.append(row)
+
+        if is_linear and rows:
+            vs = {str(v): v for v in cls.get_vars(ps_)}
+            monos = [vs[m[0][0]] if m else 1 for m in keys]
+            m = sage.all.matrix(sage.all.QQ, rows).rref()
+            ps_ = [sage.all.SR(sum(c * mono for c, mono in zip(r, monos)))
+                   == 0 for r in m.rows() if r]
+
+        return ps_, is_linear
+
     @staticmethod
     def elim_denom(p):
         """
@@ -377,130 +537,36 @@ class Miscs(object):
         return sols
 
     @classmethod
-    def solve_eqts(cls, eqts, uks, template):
-        assert isinstance(eqts, list) and eqts, eqts
-        assert isinstance(uks, list) and uks, uks
-        assert len(eqts) >= len(uks), (len(eqts), len(uks))
-
-        mlog.debug("solve {} uks using {} eqts".format(len(uks), len(eqts)))
-        # print(eqts)
-
-        # I don't think this helps
-        # @fork(timeout=settings.EQT_SOLVER_TIMEOUT, verbose=False)
-        def mysolve(eqts, uks, solution_dict):
-            return sage.all.solve(eqts, *uks, solution_dict=True)
-
-        rs = mysolve(eqts, uks, solution_dict=True)
-        assert isinstance(rs, list), rs
-        assert all(isinstance(s, dict) for s in rs), rs
-
-        # filter sols with all uks = 0, e.g., {uk_0: 0, uk_1: 0, uk_2: 0}
-        rs = [d for d in rs if not all(x == 0 for x in d.values())]
-
-        reqts = cls.instantiate_template(template, rs)
-        reqts = cls.refine(reqts)
-        # print '\n'.join(map(str, eqts))
-        # print uks
-        # print reqts
-        # CM.pause()
-
-        return reqts
-
-    @classmethod
-    def mk_template(cls, terms, rhsVal,
-                    op=sage.all.operator.eq,
-                    prefix=None, retCoefVars=False):
+    def solve_eqts(cls, rows, terms):
         """
-        get a template from terms.
-
-        Examples:
-
-        sage: from helpers.miscs import Miscs
-        sage: var('a,b,x,y')
-        (a, b, x, y)
-
-        sage: Miscs.mk_template([1, a, b, x, y],0,prefix=None)
-        (a*uk_1 + b*uk_2 + uk_3*x + uk_4*y + uk_0 == 0,
-        a*uk_1 + b*uk_2 + uk_3*x + uk_4*y + uk_0 == 0)
-
-        sage: Miscs.mk_template([1, x, y],0,\
-        op=operator.gt,prefix=None,retCoefVars=True)
-        (uk_1*x + uk_2*y + uk_0 > 0, [uk_0, uk_1, uk_2])
-
-        sage: Miscs.mk_template([1, a, b, x, y],None,prefix=None)
-        (a*uk_1 + b*uk_2 + uk_3*x + uk_4*y + uk_0,
-        a*uk_1 + b*uk_2 + uk_3*x + uk_4*y + uk_0)
-
-        sage: Miscs.mk_template([1, a, b, x, y],0,prefix='hi')
-        (a*hi1 + b*hi2 + hi3*x + hi4*y + hi0 == 0,
-        a*hi1 + b*hi2 + hi3*x + hi4*y + hi0 == 0)
-
-        sage: var('x1')
-        x1
-        sage: Miscs.mk_template([1, a, b, x1, y],0,prefix='x')
-        Traceback (most recent call last):
-        ...
-        AssertionError: name conflict
+        Find eqts over terms, i.e., c1*t1 + ... cn*tn == 0,
+        satisfied by the rows (values of the terms over traces,
+        see Traces.instantiate).
+        Each basis vector of the kernel of the rows is an eqt.
         """
+        assert isinstance(rows, list) and rows, rows
+        assert isinstance(terms, list) and terms, terms
+        assert len(rows) >= len(terms), (len(rows), len(terms))
 
-        if not prefix:
-            prefix = "uk_"
-        uks = [sage.all.var(prefix + str(i)) for i in range(len(terms))]
-
-        assert not set(terms).intersection(set(uks)), 'name conflict'
-
-        template = sum(map(sage.all.prod, zip(uks, terms)))
-
-        if rhsVal is not None:  # note, not None because rhsVal can be 0
-            template = op(template, rhsVal)
-
-        return template, uks if retCoefVars else template
+        mlog.debug("solve {} uks using {} eqts".format(len(terms), len(rows)))
+        kernel = Kernel(rows, len(terms), probe=settings.DO_RANK_PROBE)
+        reqts = cls.instantiate_kernel(terms, kernel.basis)
+        reqts = cls.refine(reqts)
+        return reqts
 
     @classmethod
-    def instantiate_template(cls, template, sols):
+    def instantiate_kernel(cls, terms, basis):
         """
-        Instantiate a template with solved coefficient values
+        Return the eqts c1*t1 + ... + cn*tn == 0 for each (c1,...,cn) in basis
 
         sage: from helpers.miscs import Miscs
-        sage: var('uk_0,uk_1,uk_2,uk_3,uk_4,r14,r15,a,b,y')
-        (uk_0, uk_1, uk_2, uk_3, uk_4, r14, r15, a, b, y)
-
-        sage: sols = [{uk_0: -2*r14 + 7/3*r15, uk_1: -1/3*r15, uk_4: r14, uk_2: r15, uk_3: -2*r14}]
-        sage: Miscs.instantiate_template(uk_1*a + uk_2*b + uk_3*x + uk_4*y + uk_0 == 0, sols)
-        [-2*x + y - 2 == 0, -1/3*a + b + 7/3 == 0]
-
-
-        sage: Miscs.instantiate_template(uk_1*a + uk_2*b + uk_3*x + uk_4*y + uk_0 == 0, [])
-        []
+        sage: var('x y')
+        (x, y)
+        sage: Miscs.instantiate_kernel([1, x, y], [(-2, 0, 1), (0, 3, -1)])
+        [y - 2 == 0, 3*x - y == 0]
         """
-        assert cls.is_expr(template), template
-
-        if not sols:
-            return []
-        if len(sols) > 1:
-            mlog.warning('instantiate_template with sols: len(sols) = {}'
-                         .format(len(sols)))
-            mlog.warning(str(sols))
-
-        def fEq(d):
-            f_ = template(d)
-            uk_vars = cls.get_vars(d.values())  # e.g., r15,r16 ...
-
-            if not uk_vars:
-                return f_
-
-            iM = sage.all.identity_matrix(len(uk_vars))  # standard basis
-            rs = [dict(zip(uk_vars, l)) for l in iM.rows()]
-            rs = [f_(r) for r in rs]
-            return rs
-
-        sols = [y for x in sols for y in fEq(x)]
-
-        # remove trivial (tautology) str(x) <=> str(x)
-        sols = [s for s in sols
-                if not (s.is_relational() and str(s.lhs()) == str(s.rhs()))]
-
-        return sols
+        return [sum(cls.to_sagenum(c) * t for c, t in zip(v, terms) if c) == 0
+                for v in basis]
 
     @staticmethod
     def show_removed(s, orig_siz, new_siz, elapsed_time):
@@ -512,92 +578,22 @@ class Miscs(object):
                    .format(s, n_removed, elapsed_time, orig_siz, new_siz))
 
     @classmethod
-    def get_workload(cls, tasks, n_cpus):
+    def run_mp(cls, taskname, tasks, f, cost=None,
+               timeout=None, phase_timeout=None, on_timeout=None):
         """
-        sage: from helpers.miscs import Miscs
-
-        >>> wls = Miscs.get_workload(range(12),7); [len(wl) for wl in wls]
-        [1, 1, 2, 2, 2, 2, 2]
-
-        >>> wls = Miscs.get_workload(range(12),5); [len(wl) for wl in wls]
-        [2, 2, 2, 3, 3]
-
-        >>> wls = Miscs.get_workload(range(20),7); [len(wl) for wl in wls]
-        [2, 3, 3, 3, 3, 3, 3]
-
-        >>> wls = Miscs.get_workload(range(20),20); [len(wl) for wl in wls]
-        [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
-
-        >>> wls = Miscs.get_workload(range(12),7); [len(wl) for wl in wls]
-        [1, 1, 2, 2, 2, 2, 2]
-
-        >>> wls = Miscs.get_workload(range(146), 20); [len(wl) for wl in wls]
-            [7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 8, 8, 8, 8, 8, 8]
+        Run f on tasks in parallel (see helpers.pool.Pool)
         """
-        assert len(tasks) >= 1, tasks
-        assert n_cpus >= 1, n_cpus
-
-        wloads = defaultdict(list)
-        for i, task in enumerate(tasks):
-            cpu_id = i % n_cpus
-            wloads[cpu_id].append(task)
-
-        wloads = [wl for wl in
-                  sorted(wloads.values(), key=lambda wl: len(wl))]
-
-        return wloads
+        return helpers.pool.get_pool().map(
+            taskname, tasks, f, cost, timeout, phase_timeout, on_timeout)
 
     @classmethod
-    def run_mp(cls, taskname, tasks, f):
+    def irun_mp(cls, taskname, tasks, f, cost=None,
+                timeout=None, phase_timeout=None, on_timeout=None):
         """
-        Run wprocess on tasks in parallel
+        Like run_mp, but yield the results as soon as their tasks are done
         """
-        def wprocess(mytasks, myQ):
-            rs = f(mytasks)
-            if myQ is None:
-                return rs
-            else:
-                myQ.put(rs)
-
-        n_cpus = multiprocessing.cpu_count()
-        if settings.DO_MP and len(tasks) >= 2 and n_cpus >= 2:
-            Q = multiprocessing.Queue()
-            wloads = cls.get_workload(tasks, n_cpus=n_cpus)
-            mlog.debug("{}:running {} jobs using {} threads: {}".format(
-                taskname, len(tasks), len(wloads), list(map(len, wloads))))
-
-            workers = [multiprocessing.Process(
-                target=wprocess, args=(wl, Q)) for wl in wloads]
-
-            for w in workers:
-                w.start()
-
-            wrs = [x for _ in workers for x in Q.get()]
-
-        else:
-            wrs = wprocess(tasks, myQ=None)
-
-        return wrs
-
-    @staticmethod
-    def simplify_idxs(ordered_idxs, imply_f):
-        """
-        attempt to remove i in idxs if imply_f returns true
-        Note: the order of idxs determine what to get checked (and removed) 
-        """
-        assert isinstance(ordered_idxs, list), ordered_idxs
-        assert ordered_idxs == list(range(len(ordered_idxs))), ordered_idxs
-
-        results = set(ordered_idxs)
-
-        for i in reversed(ordered_idxs):
-            if i not in results:
-                continue
-            others = results - {i}
-            if others and imply_f(others, i):
-                results = others
-
-        return sorted(results)
+        return helpers.pool.get_pool().imap(
+            taskname, tasks, f, cost, timeout, phase_timeout, on_timeout)
 
 
 class Z3(object):
@@ -658,18 +654,33 @@ class Z3(object):
         return cexs, isSucc
 
     @classmethod
-    def get_models(cls, f, k):
+    def get_models(cls, f, k, solver=None):
         """
         Returns the first k models satisfiying f.
         If f is not satisfiable, returns False.
         If f cannot be solved, returns None
         If f is satisfiable, returns the first k models
         Note that if f is a tautology, i.e., True, then the result is []
+
+        If solver is given, f is checked together with the solver's
+        assertions in a new scope, which is popped afterwards.
         """
         assert z3.is_expr(f), f
         assert k >= 1, k
-        solver = cls.create_solver(maximize=None)
-        solver.add(f)
+        if solver is None:
+            solver = cls.create_solver(maximize=None)
+            solver.add(f)
+            return cls._get_models(solver, k)
+
+        solver.push()
+        try:
+            solver.add(f)
+            return cls._get_models(solver, k)
+        finally:
+            solver.pop()
+
+    @classmethod
+    def _get_models(cls, solver, k):
         models = []
         i = 0
         while solver.check() == z3.sat and i < k:
@@ -699,14 +710,6 @@ class Z3(object):
                 rs = None
                 stat = z3.unknown
 
-        if (isinstance(rs, list) and not rs):
-            print(f)
-            print(k)
-            print(stat)
-            print(models)
-
-            DBG()
-
         assert not (isinstance(rs, list) and not rs), rs
         return rs, stat
 
@@ -774,6 +777,102 @@ class Z3(object):
         models, _ = cls.get_models(z3.Not(claim), k=1)
         return models is False
 
+    @classmethod
+    def simplify_idxs(cls, fs, is_conj=True, keeps=()):
+        """
+        Remove fs that are implied by the remaining fs (is_conj) or that
+        imply the disjunction of the remaining fs (not is_conj), trying
+        the fs in reversed order. Idxs in keeps are never removed.
+        Return the idxs of the remaining fs.
+
+        All fs are added once to a single solver, each guarded by an
+        assumption literal, together with the negation of And(fs)
+        (resp. Or(fs)). A check on the guards of the remaining fs
+        without f is unsat iff f can be removed, and then the unsat core
+        tells which fs are needed, so all fs outside the core are
+        removed at once without a check of their own.
+
+        >>> x, y = z3.Ints('x y')
+        >>> Z3.simplify_idxs([x >= 0, y >= 0, x + y >= 0, x >= -1, y >= 0])
+        [0, 1]
+        >>> Z3.simplify_idxs([x >= 0, y >= 0, x + y >= 0], keeps=[2])
+        [0, 1, 2]
+        >>> Z3.simplify_idxs([x >= 0, x >= 1, y >= 0], is_conj=False)
+        [0, 2]
+        """
+        assert all(z3.is_expr(f) for f in fs), fs
+
+        solver = cls.create_solver(maximize=None)
+        guards = [z3.FreshBool('_dig_simp') for _ in fs]
+        for guard, f in zip(guards, fs):
+            # conj: guard => f,  disj: guard => not f
+            solver.add(z3.Implies(guard, f if is_conj else z3.Not(f)))
+        solver.add(z3.Not(z3.And(fs)) if is_conj else z3.Or(fs))
+        gidxs = {guard.get_id(): i for i, guard in enumerate(guards)}
+
+        keeps = set(keeps)
+        results = set(range(len(fs)))
+        for i in reversed(range(len(fs))):
+            if i not in results or i in keeps:
+                continue
+            others = sorted(results - {i})
+            if others and \
+                    solver.check(*[guards[j] for j in others]) == z3.unsat:
+                core = set(gidxs[c.get_id()] for c in solver.unsat_core())
+                results = core | (results & keeps)
+
+        return sorted(results)
+
+    @classmethod
+    def simplify_conj(cls, fs, g, solver=None, stats=None):
+        """
+        Return the idxs of a subset of fs whose conjunction implies g,
+        (together with the assertions of solver if given), or None if
+        the conjunction of all fs does not imply g.
+        Unsat cores are used to drop all fs not needed in a proof,
+        so most fs are removed without a solver call of their own.
+        If stats is given, the result of each check is appended to it.
+
+        >>> x, y = z3.Ints('x y')
+        >>> Z3.simplify_conj([x >= 1, x >= 2, y >= 0], x + y >= 2)
+        [1, 2]
+        >>> Z3.simplify_conj([x >= 1], x >= 2)
+        """
+        assert all(z3.is_expr(f) for f in fs), fs
+        assert z3.is_expr(g), g
+
+        if solver is None:
+            solver = cls.create_solver(maximize=None)
+        solver.push()
+        try:
+            guards = [z3.FreshBool('_dig_simp') for _ in fs]
+            for guard, f in zip(guards, fs):
+                solver.add(z3.Implies(guard, f))
+            solver.add(z3.Not(g))
+            gidxs = {guard.get_id(): i for i, guard in enumerate(guards)}
+
+            def get_core(idxs):
+                stat = solver.check(*[guards[i] for i in idxs])
+                if stats is not None:
+                    stats.append(stat)
+                if stat != z3.unsat:
+                    return None
+                return set(gidxs[c.get_id()] for c in solver.unsat_core())
+
+            results = get_core(range(len(fs)))
+            if results is None:
+                return None
+
+            for i in sorted(results, reverse=True):
+                if i not in results:
+                    continue
+                core = get_core(sorted(results - {i}))
+                if core is not None:
+                    results = core
+            return sorted(results)
+        finally:
+            solver.pop()
+
     @classmethod
     def _mycmp_(cls, f, g):
         """
@@ -796,6 +895,74 @@ class Z3(object):
         else:
             return -1
 
+    _caches = {}
+    _caches_pid = None
+    parse_hits = 0
+    parse_misses = 0
+
+    @classmethod
+    def get_cache(cls, name):
+        """
+        LRU caches of z3 exprs, e.g., parse results (str, use_reals) -> expr.
+        z3 exprs cannot be sent to other processes, so the caches are per
+        process, i.e., a forked worker starts with empty caches and
+        fills them lazily.
+        """
+        pid = os.getpid()
+        if cls._caches_pid != pid:
+            cls._caches = {}
+            cls._caches_pid = pid
+            cls.parse_hits = cls.parse_misses = 0
+        try:
+            return cls._caches[name]
+        except KeyError:
+            cls._caches[name] = OrderedDict()
+            return cls._caches[name]
+
+    @classmethod
+    def put_cache(cls, cache, key, expr):
+        cache[key] = expr
+        if len(cache) > settings.PARSE_CACHE_SIZE:
+            cache.popitem(last=False)
+
+    @classmethod
+    def to_smt2(cls, f):
+        """
+        Serialize f to an SMT-LIB2 string (with declarations),
+        e.g., to send it to another process (see from_smt2)
+
+        sage: from helpers.miscs import Z3
+        sage: x, y = z3.Ints('x y')
+        sage: f = z3.And(x + y >= 3, x <= y)
+        sage: Z3.from_smt2(Z3.to_smt2(f)).eq(f)
+        True
+        """
+        assert z3.is_expr(f), f
+        solver = z3.Solver()
+        solver.add(f)
+        return solver.to_smt2()
+
+    @classmethod
+    def from_smt2(cls, s):
+        assert isinstance(s, str), s
+        cache = cls.get_cache('smt2')
+        try:
+            f = cache[s]
+            cache.move_to_end(s)
+            return f
+        except KeyError:
+            pass
+
+        fs = list(z3.parse_smt2_string(s))
+        if not fs:  # e.g., True
+            f = z3.BoolVal(True)
+        elif len(fs) == 1:
+            f = fs[0]
+        else:
+            f = z3.And(fs)
+        cls.put_cache(cache, s, f)
+        return f
+
     @classmethod
     def parse(cls, node, use_reals):
         """
@@ -807,6 +974,16 @@ class Z3(object):
         # print(ast.dump(node))
 
         if isinstance(node, str):
+            cache = cls.get_cache('parse')
+            key = (node, use_reals)
+            try:
+                expr = cache[key]
+                cache.move_to_end(key)
+                cls.parse_hits += 1
+                return expr
+            except KeyError:
+                cls.parse_misses += 1
+
             node = node.replace('^', '**')
 
             tnode = ast.parse(node)
@@ -814,12 +991,14 @@ class Z3(object):
             try:
                 expr = cls.parse(tnode, use_reals)
                 expr = z3.simplify(expr)
-                return expr
             except NotImplementedError:
                 mlog.error("cannot parse: '{}'\n{}".format(
                     node, ast.dump(tnode)))
                 raise
 
+            cls.put_cache(cache, key, expr)
+            return expr
+
         elif isinstance(node, ast.BoolOp):
             vals = [cls.parse(v, use_reals) for v in node.values]
             op = cls.parse(node.op, use_reals)
@@ -0,0 +1,490 @@
+"""
+Process pool for running tasks in parallel (see Miscs.run_mp)
+"""
+import atexit
+import collections
+import io
+import marshal
+import multiprocessing
+import multiprocessing.connection
+import pdb
+import pickle
+import sys
+import time
+import traceback
+import types
+
+import helpers.vcommon as CM
+import settings
+
+DBG = pdb.set_trace
+mlog = CM.getLogger(__name__, settings.logger_level)
+
+
+_pool = None  # the pool shared by the whole run (see get_pool)
+_shared = {}  # id -> obj, passed by reference to the workers (see Pool.start)
+
+
+def _make_func(code, modname, name, defaults, kwdefaults, cells):
+    f = types.FunctionType(marshal.loads(code), sys.modules[modname].__dict__,
+                           name, defaults,
+                           tuple(types.CellType(c) for c in cells) or None)
+    f.__kwdefaults__ = kwdefaults
+    return f
+
+
+class _Pickler(pickle.Pickler):
+    """
+    Pickle the shared objects by reference, and closures and lambdas,
+    which pickle cannot import by name, by value (code, globals by
+    module, and cell contents)
+    """
+
+    def persistent_id(self, obj):
+        key = id(obj)
+        return key if key in _shared and _shared[key] is obj else None
+
+    def reducer_override(self, obj):
+        if not (isinstance(obj, types.FunctionType) and
+                '<' in obj.__qualname__):  # <locals> or <lambda>
+            return NotImplemented
+        cells = tuple(c.cell_contents for c in obj.__closure__ or ())
+        return _make_func, (marshal.dumps(obj.__code__), obj.__module__,
+                            obj.__name__, obj.__defaults__,
+                            obj.__kwdefaults__, cells)
+
+
+class _Unpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        return _shared[pid]
+
+
+def _work(conn, job=None):
+    """
+    Worker loop: receive a job (pickled f and tasks) and send back
+    whether it is loaded, or a chunk (task idxs) of the current job
+    and send back f(chunk), until receiving None (or the parent is gone)
+    """
+    global _pool
+    if _pool is not None:  # the parent's pool, e.g., pipes of other workers
+        for wconn, _ in filter(None, _pool.workers):
+            wconn.close()
+        _pool = None
+
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        if msg is None:
+            break
+        is_job, data = msg
+        if is_job:
+            try:
+                job = _Unpickler(io.BytesIO(data)).load()
+                conn.send((True, None, None))
+            except Exception:
+                job = None
+                conn.send((False, traceback.format_exc(), None))
+            continue
+
+        st = time.time()
+        try:
+            f, tasks = job
+            rs = f([tasks[i] for i in data])
+            conn.send((True, rs, time.time() - st))
+        except Exception:
+            conn.send((False, traceback.format_exc(), None))
+    conn.close()
+
+
+class Pool:
+    """
+    Run f(tasks) in parallel, where f maps a list of tasks to a list of
+    results, e.g., f(tasks) = [g(t) for t in tasks].
+
+    The long-lived workers are forked once by start, after the setup
+    (e.g., sage/z3 and the symbolic states), so they inherit that state.
+    For each map, f and tasks are pickled once and sent to each worker,
+    closures included (by value), but with the shared objects given to
+    start (e.g., symstates) passed by reference to the workers' copies.
+    Then only the task idxs of each chunk are sent.
+    A map whose f or tasks cannot be pickled (e.g., they hold z3 exprs),
+    or any map before start, forks its own workers, which share the
+    current state (copy-on-write) and run any closure over it.
+
+    Each worker has its own queue of tasks, filled longest first (LPT)
+    and preferring the worker that ran tasks with the same feature
+    (e.g., loc) before, as it may have cached solvers for them.
+    An idle worker takes chunks of decreasing sizes from its own queue,
+    and, once it is empty, steals the cheaper half of the most loaded
+    queue, so a worker finishing early takes over the remaining tasks
+    instead of waiting for the slow ones.
+    An exception in a worker (or a dead worker) is raised in the parent.
+
+    If cost is given, cost(task) returns (feature, estimate), where
+    feature (hashable, e.g., the loc and the number of vars of a term)
+    groups similar tasks and estimate is a relative cost,
+    e.g., the number of path conditions.
+    The estimates are scaled by the time per estimate unit measured
+    for the feature (or the taskname) in previous maps.
+
+    >>> Pool(3).map("double", list(range(10)), lambda ts: [2*t for t in ts])
+    [0, 2, 4, 6, 8, 10, 12, 14, 16, 18]
+    >>> pool = Pool(2)
+    >>> pool.start()
+    >>> pool.map("double", list(range(10)), lambda ts: [2*t for t in ts])
+    [0, 2, 4, 6, 8, 10, 12, 14, 16, 18]
+    >>> pool.stop()
+    """
+
+    def __init__(self, n_cpus):
+        assert n_cpus >= 1, n_cpus
+        self.n_cpus = n_cpus
+        self.rates = {}  # taskname or (taskname, feature) -> secs per unit
+        self.timeouts = {}  # taskname -> number of tasks timed out
+        self.workers = []  # long-lived (conn, process), None if killed
+        self.affinity = {}  # (taskname, feature) -> idx of worker
+
+    def start(self, shared=()):
+        """
+        Fork the long-lived workers (see Pool), replacing the old ones.
+        The shared objects must not change afterwards, as the workers
+        keep using their own copies (so do module globals, e.g., settings).
+        """
+        self.stop()
+        _shared.clear()
+        _shared.update((id(obj), obj) for obj in shared)
+        if not settings.DO_MP:
+            return
+        self.workers = [self._fork() for _ in range(self.n_cpus)]
+        atexit.unregister(self.stop)
+        atexit.register(self.stop)
+        mlog.debug("started {} workers".format(self.n_cpus))
+
+    def stop(self):
+        for worker in filter(None, self.workers):
+            conn, w = worker
+            conn.send(None)
+            conn.close()
+            w.join()
+        self.workers = []
+        self.affinity = {}
+
+    @classmethod
+    def _fork(cls, job=None):
+        conn, wconn = multiprocessing.Pipe()
+        w = multiprocessing.get_context('fork').Process(
+            target=_work, args=(wconn, job))
+        w.start()
+        wconn.close()
+        return conn, w
+
+    def _load(self, taskname, job, ks):
+        """
+        Give the job to the long-lived workers ks (forking the dead ones)
+        and return whether they all loaded it, e.g., they cannot if it
+        uses a global defined after start
+        """
+        for k in ks:
+            if self.workers[k] is None or not self.workers[k][1].is_alive():
+                self.workers[k] = self._fork()
+            self.workers[k][0].send((True, job))
+        errs = [err for is_succ, err, _ in
+                (self.workers[k][0].recv() for k in ks) if not is_succ]
+        if errs:
+            mlog.debug("{}: cannot load job ({}), fork workers".format(
+                taskname, errs[0].strip().splitlines()[-1]))
+        return not errs
+
+    @classmethod
+    def _dumps(cls, taskname, f, tasks):
+        """
+        Return (f, tasks) pickled for the workers, or None if they
+        cannot be pickled
+        """
+        buf = io.BytesIO()
+        try:
+            _Pickler(buf, pickle.HIGHEST_PROTOCOL).dump((f, tasks))
+        except Exception as ex:
+            mlog.debug("{}: cannot pickle job ({}), fork workers".format(
+                taskname, ex))
+            return None
+        return buf.getvalue()
+
+    def get_cost(self, taskname, feature, estimate):
+        rate = self.rates.get((taskname, feature),
+                              self.rates.get(taskname, 1.0))
+        return estimate * rate
+
+    def update_rates(self, taskname, features, estimates, secs):
+        """
+        Feed back the time spent on tasks with these features and estimates
+        """
+        estimate = sum(estimates)
+        if estimate <= 0:
+            return
+        rate = secs / estimate
+        keys = set((taskname, feature) for feature in features
+                   if feature is not None)
+        for key in keys | {taskname}:
+            old = self.rates.get(key)
+            self.rates[key] = rate if old is None else (old + rate) / 2
+
+    def map(self, taskname, tasks, f, cost=None,
+            timeout=None, phase_timeout=None, on_timeout=None):
+        """
+        Return the results of f on tasks, in the order of tasks
+        (of the chunks if cost is given), see imap
+        """
+        wrs = sorted(self._imap(taskname, tasks, f, cost,
+                                timeout, phase_timeout, on_timeout),
+                     key=lambda ir: ir[0])
+        return [r for _, rs in wrs for r in rs]
+
+    def imap(self, taskname, tasks, f, cost=None,
+             timeout=None, phase_timeout=None, on_timeout=None):
+        """
+        Like map, but yield the results as soon as their tasks are done.
+
+        A task taking longer than timeout secs (or timeout(task) secs if
+        timeout is a function, e.g., scaled by the size of a batch task),
+        or still not done after phase_timeout secs since the start,
+        is killed (together with its worker) and on_timeout(task),
+        which defaults to [], is used as its results.
+        Timeouts are only enforced with workers, so a worker is used for
+        a single task (or a single cpu) when a timeout is given, but not
+        if settings.DO_MP is off.
+
+        >>> import time
+        >>> def f(ts): return [time.sleep(t) or t for t in ts]
+        >>> pool = Pool(2)
+        >>> sorted(pool.imap("sleep", [0, 5, 0.1], f, timeout=1,
+        ...                  on_timeout=lambda t: [-t]))
+        [-5, 0, 0.1]
+        >>> pool.timeouts
+        {'sleep': 1}
+        """
+        return (r for _, rs in self._imap(taskname, tasks, f, cost,
+                                          timeout, phase_timeout, on_timeout)
+                for r in rs)
+
+    def _imap(self, taskname, tasks, f, cost,
+              timeout, phase_timeout, on_timeout):
+        """
+        Yield (min idx of chunk, results of chunk)
+        """
+        assert isinstance(tasks, list), tasks
+        assert timeout is None or callable(timeout) or timeout > 0, timeout
+        assert phase_timeout is None or phase_timeout > 0, phase_timeout
+
+        if cost is None:
+            features, estimates = [None] * len(tasks), [1] * len(tasks)
+        else:
+            features, estimates = list(zip(*map(cost, tasks))) or ((), ())
+
+        has_timeout = timeout is not None or phase_timeout is not None
+        if not (settings.DO_MP and tasks and
+                (has_timeout or len(tasks) >= 2 and self.n_cpus >= 2)):
+            st = time.time()
+            wrs = f(tasks)
+            self.update_rates(taskname, features, estimates, time.time() - st)
+            yield 0, wrs
+            return
+
+        n_workers = min(self.n_cpus, len(tasks))
+        if timeout is not None:
+            timeouts = [timeout(task) if callable(timeout) else timeout
+                        for task in tasks]
+            assert all(t > 0 for t in timeouts), timeouts
+        costs = [self.get_cost(taskname, feature, estimate)
+                 for feature, estimate in zip(features, estimates)]
+
+        job = self._dumps(taskname, f, tasks) if self.workers else None
+        if job is not None and not self._load(
+                taskname, job, range(n_workers)):
+            job = None
+        mlog.debug("{}:running {} jobs using {} {}workers".format(
+            taskname, len(tasks), n_workers,
+            "forked " if job is None else ""))
+
+        # longest first to the queue of the worker that ran the feature,
+        # or the least loaded, and contiguous blocks if no cost, so that
+        # chunks (stolen ones included) keep the order of tasks
+        queues = [collections.deque() for _ in range(n_workers)]
+        loads = [0.0] * n_workers
+        for i in sorted(range(len(tasks)), key=lambda i: -costs[i]):
+            k = self.affinity.get((taskname, features[i]))
+            if cost is None:
+                k = i * n_workers // len(tasks)
+            elif features[i] is None or k is None or k >= n_workers:
+                k = min(range(n_workers), key=lambda k: loads[k])
+            queues[k].append(i)
+            loads[k] += costs[i]
+
+        def get_chunk(k):
+            queue = queues[k]
+            if not queue:
+                # steal the back (cheaper) half of the most loaded queue
+                v = max(range(n_workers), key=lambda v: loads[v])
+                half, c = loads[v] / 2, 0.0
+                while queues[v] and \
+                        (not queue or c + costs[queues[v][-1]] <= half):
+                    i = queues[v].pop()
+                    queue.appendleft(i)
+                    c += costs[i]
+                loads[v] -= c
+                loads[k] += c
+            if not queue:
+                return None
+
+            # guided scheduling, i.e., chunks of about half of the queue,
+            # so the expensive first tasks and the last ones go alone,
+            # and single tasks if they have their own timeout
+            target = loads[k] / 2
+            chunk = [queue.popleft()]
+            c = costs[chunk[0]]
+            while (timeout is None and queue and
+                   c + costs[queue[0]] <= target):
+                chunk.append(queue.popleft())
+                c += costs[chunk[-1]]
+            loads[k] -= c
+            return chunk
+
+        def timed_out(chunk):
+            self.timeouts[taskname] = self.timeouts.get(taskname, 0) + \
+                len(chunk)
+            rs = [r for i in chunk
+                  for r in (on_timeout(tasks[i]) if on_timeout else [])]
+            return min(chunk), rs
+
+        slots = [None] * n_workers  # (conn, process) running queue k
+        running, started, ks = {}, {}, {}  # conn -> chunk, start time, k
+
+        def spawn(k):
+            # fork a worker for this job, or use the long-lived one
+            if job is None:
+                slots[k] = self._fork((f, tasks))
+                return
+            if self.workers[k] is None and not self._load(taskname, job, [k]):
+                raise RuntimeError("{}: worker cannot load job".format(
+                    taskname))
+            slots[k] = self.workers[k]
+
+        def give(k):
+            # give worker k a chunk, if any is left
+            chunk = get_chunk(k)
+            if chunk is None:
+                return
+            conn = slots[k][0]
+            running[conn], started[conn], ks[conn] = chunk, time.time(), k
+            conn.send((False, chunk))
+            if job is not None:
+                self.affinity.update(((taskname, features[i]), k)
+                                     for i in chunk if features[i] is not None)
+
+        def kill(conn):
+            k = ks.pop(conn)
+            conn, w = slots[k]
+            w.terminate()
+            w.join()
+            conn.close()
+            slots[k] = None
+            if job is not None:
+                self.workers[k] = None
+            started.pop(conn)
+            return k, running.pop(conn)
+
+        is_ok = False
+        st, work = time.time(), 0.0
+        deadline = None if phase_timeout is None else st + phase_timeout
+        try:
+            for k in range(n_workers):
+                spawn(k)
+                give(k)
+
+            while running:
+                waits = []
+                if timeout is not None:
+                    waits.extend(started[conn] + timeouts[running[conn][0]]
+                                 for conn in running)
+                if deadline is not None:
+                    waits.append(deadline)
+                wait_secs = max(0, min(waits) - time.time()) if waits else None
+
+                for conn in multiprocessing.connection.wait(
+                        list(running), wait_secs):
+                    try:
+                        is_succ, rs, secs = conn.recv()
+                    except EOFError:
+                        _, chunk = kill(conn)
+                        raise RuntimeError(
+                            "{}: worker died on tasks {}".format(
+                                taskname, chunk))
+                    chunk, k = running.pop(conn), ks.pop(conn)
+                    started.pop(conn)
+                    if not is_succ:
+                        raise RuntimeError("{}: worker failed on tasks {}\n{}"
+                                           .format(taskname, chunk, rs))
+                    work += secs
+                    self.update_rates(
+                        taskname, [features[i] for i in chunk],
+                        [estimates[i] for i in chunk], secs)
+                    give(k)
+                    yield min(chunk), rs
+
+                now = time.time()
+                if deadline is not None and now >= deadline:
+                    chunks = [kill(conn)[1] for conn in list(running)]
+                    chunks.extend([i] for queue in queues for i in queue)
+                    for queue in queues:
+                        queue.clear()
+                    mlog.warning("{}: {} tasks not done in {}s".format(
+                        taskname, len(chunks), phase_timeout))
+                    for chunk in chunks:
+                        yield timed_out(chunk)
+                    break
+
+                if timeout is not None:
+                    for conn in list(running):
+                        secs = timeouts[running[conn][0]]
+                        if now - started[conn] < secs:
+                            continue
+                        k, chunk = kill(conn)
+                        mlog.warning("{}: task {} not done in {}s".format(
+                            taskname, chunk, secs))
+                        if any(queues):
+                            spawn(k)
+                            give(k)
+                        yield timed_out(chunk)
+            is_ok = True
+        finally:
+            for k, slot in enumerate(slots):
+                if slot is None:
+                    continue
+                conn, w = slot
+                if job is None:  # this map's own workers
+                    if is_ok:
+                        conn.send(None)
+                    else:
+                        w.terminate()
+                    conn.close()
+                    w.join()
+                elif conn in running:  # busy, e.g., after an exception
+                    w.terminate()
+                    w.join()
+                    conn.close()
+                    self.workers[k] = None
+
+        mlog.debug("{}: {:.2f}s of work using {} workers in {:.2f}s".format(
+            taskname, work, n_workers, time.time() - st))
+
+
+def get_pool():
+    """
+    Return the pool shared by the whole run
+    """
+    global _pool
+    if _pool is None:
+        _pool = Pool(multiprocessing.cpu_count())
+    return _pool
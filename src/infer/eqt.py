@@ -6,6 +6,7 @@ import pdb
 import settings
 import helpers.vcommon as CM
 from helpers.miscs import Miscs
+from helpers.linalg import Kernel
 
 from data.traces import Inps, Traces, DTraces
 from data.inv.invs import Invs, DInvs
@@ -35,8 +36,8 @@ class Infer(infer.base.Infer):
 
         # then solve/prove in parallel
         def f(tasks):
-            return [(loc, self._infer(loc, template, uks, exprs, traces, inps))
-                    for loc, (template, uks, exprs) in tasks]
+            return [(loc, self._infer(loc, terms, exprs, traces, inps))
+                    for loc, (terms, exprs) in tasks]
         wrs = Miscs.run_mp('find eqts', tasks, f)
 
         # put results together
@@ -52,19 +53,19 @@ class Infer(infer.base.Infer):
         return dinvs
 
     # PRIVATE
-    def add_exprs(cls, template, n_eqts_needed, traces, exprs):
+    def add_exprs(cls, terms, n_eqts_needed, traces, exprs):
         assert traces
         mlog.debug("got {} new traces".format(len(traces)))
-        new_exprs = traces.instantiate(template, n_eqts_needed - len(exprs))
+        new_exprs = traces.instantiate(terms, n_eqts_needed - len(exprs))
         for expr in new_exprs:
             assert expr not in exprs
             exprs.add(expr)
 
-    def _while_rand(self, loc, template, n_eqts_needed, inps, traces):
+    def _while_rand(self, loc, terms, n_eqts_needed, inps, traces):
         """
         repeatedly get more inps using random method
         """
-        exprs = traces[loc].instantiate(template, n_eqts_needed)
+        exprs = traces[loc].instantiate(terms, n_eqts_needed)
 
         doRand = True
         while n_eqts_needed > len(exprs):
@@ -101,18 +102,18 @@ class Infer(infer.base.Infer):
                                    len(traces[loc]) if loc in traces else 0))
                     return
 
-            self.add_exprs(template, n_eqts_needed, new_traces[loc], exprs)
+            self.add_exprs(terms, n_eqts_needed, new_traces[loc], exprs)
 
         return exprs
 
-    def _while_symstates(self, loc, template, n_eqts_needed, inps, traces):
+    def _while_symstates(self, loc, terms, n_eqts_needed, inps, traces):
         """
         repeated get more traces using the symstates (e.g., Klee)
         """
         assert isinstance(loc, str), loc
         assert n_eqts_needed >= 1, n_eqts_needed
 
-        exprs = traces[loc].instantiate(template, n_eqts_needed)
+        exprs = traces[loc].instantiate(terms, n_eqts_needed)
         while n_eqts_needed > len(exprs):
             mlog.debug("{}: need more traces ({} eqts, need >= {})"
                        .format(loc, len(exprs), n_eqts_needed))
@@ -126,7 +127,7 @@ class Infer(infer.base.Infer):
             new_inps = inps.merge(cexs, self.inp_decls.names)
             new_traces = self.get_traces(new_inps, traces)
 
-            self.add_exprs(template, n_eqts_needed, new_traces[loc], exprs)
+            self.add_exprs(terms, n_eqts_needed, new_traces[loc], exprs)
 
         return exprs
 
@@ -143,9 +144,9 @@ class Infer(infer.base.Infer):
         mlog.debug("{}: gen init inps using {} (curr inps {}, traces {})"
                    .format(loc, whileFName, len(inps), len(traces)))
 
-        terms, template, uks, n_eqts_needed = Miscs.init_terms(
+        terms, n_eqts_needed = Miscs.init_terms(
             self.inv_decls[loc].names, deg, rate)
-        exprs = whileF(loc, template, n_eqts_needed, inps, traces)
+        exprs = whileF(loc, terms, n_eqts_needed, inps, traces)
 
         # if cannot generate sufficient traces, adjust degree
         while (not exprs):
@@ -153,35 +154,37 @@ class Infer(infer.base.Infer):
                 return  # cannot generate enough traces
 
             deg = deg - 1
-            mlog.info("Reduce polynomial degree to {}, terms {}, uks {}"
-                      .format(deg, len(terms), len(uks)))
-            terms, template, uks, n_eqts_needed = Miscs.init_terms(
+            mlog.info("Reduce polynomial degree to {}, terms {}"
+                      .format(deg, len(terms)))
+            terms, n_eqts_needed = Miscs.init_terms(
                 self.inv_decls[loc].names, deg, rate)
-            exprs = whileF(loc, template, n_eqts_needed, inps, traces)
+            exprs = whileF(loc, terms, n_eqts_needed, inps, traces)
 
-        return template, uks, exprs
+        return terms, exprs
 
-    def _infer(self, loc, template, uks, exprs, dtraces, inps):
+    def _infer(self, loc, terms, exprs, dtraces, inps):
         assert isinstance(loc, str) and loc, loc
-        assert Miscs.is_expr(template), template
-        assert isinstance(uks, list), uks
+        assert isinstance(terms, list) and terms, terms
         assert isinstance(exprs, set) and exprs, exprs
         assert isinstance(dtraces, DTraces) and dtraces, dtraces
         assert isinstance(inps, Inps) and inps, inps
 
         cache = set()
         eqts = set()  # results
-        exprs = list(exprs)
+        # the kernel is kept across iterations and shrunk by cex rows
+        kernel = Kernel(list(exprs), len(terms),
+                        probe=settings.DO_RANK_PROBE)
 
         new_cexs = []
         curIter = 0
 
         while True:
             curIter += 1
-            mlog.debug("{}, iter {} infer using {} exprs"
-                       .format(loc, curIter, len(exprs)))
+            mlog.debug("{}, iter {} infer using {} exprs (kernel dim {})"
+                       .format(loc, curIter, len(kernel.rows), kernel.dim))
 
-            new_eqts = Miscs.solve_eqts(exprs, uks, template)
+            new_eqts = Miscs.refine(
+                Miscs.instantiate_kernel(terms, kernel.basis))
             unchecks = [eqt for eqt in new_eqts if eqt not in cache]
 
             if not unchecks:
@@ -208,8 +211,9 @@ class Infer(infer.base.Infer):
 
             cexs = Traces.extract(cexs[loc])
             cexs = cexs.padzeros(set(self.inv_decls[loc].names))
-            exprs_ = cexs.instantiate(template, None)
-            mlog.debug("{}: {} new cex exprs".format(loc, len(exprs_)))
-            exprs.extend(exprs_)
+            exprs_ = cexs.instantiate(terms, None)
+            nchanges = kernel.add_rows(sorted(exprs_))
+            mlog.debug("{}: {} new cex exprs ({} shrink kernel)"
+                       .format(loc, len(exprs_), nchanges))
 
         return eqts, new_cexs
@@ -15,11 +15,13 @@ import helpers.vcommon as CM
 import helpers.miscs
 
 import settings
+import analysis
 import data.traces
 import data.poly.base
 import data.inv.oct
 import data.poly.mp
 import data.inv.mp
+import data.symstates
 import infer.base
 
 DBG = pdb.set_trace
@@ -54,18 +56,56 @@ class Infer(infer.base.Infer, metaclass=ABCMeta):
         mlog.debug("infer upperbounds for {} terms at {} locs".format(
             len(tasks), len(locs)))
 
-        def f(tasks):
-            return [(loc, term,
-                     self.maximize(loc, term, extra_constr, dtraces))
-                    for loc, term in tasks]
-        wrs = helpers.miscs.Miscs.run_mp('optimize upperbound', tasks, f)
+        if settings.DO_BOX_OPT:
+            # terms at a loc are maximized together
+            tasks = data.symstates.SymStates.mk_batches(tasks)
+
+            def f(tasks):
+                return [(loc, term, v) for loc, terms in tasks
+                        for term, v in zip(terms, self.maximize_terms(
+                            loc, terms, extra_constr, dtraces))]
+        else:
+            def f(tasks):
+                return [(loc, term,
+                         self.maximize(loc, term, extra_constr, dtraces))
+                        for loc, term in tasks]
+
+        def cost(task):
+            # optimizing a term over more vars (or a max-plus term)
+            # is much harder, e.g., more disjuncts and larger bounds
+            loc, terms = task
+            terms = terms if isinstance(terms, list) else [terms]
+            nvars = max(len(term.symbols) for term in terms)
+            feature = (loc, type(terms[0]).__name__, nvars)
+            return feature, \
+                len(terms) * 2**nvars * self.symstates.get_cost(loc)
+
+        def on_timeout(task):
+            loc, terms = task
+            terms = terms if isinstance(terms, list) else [terms]
+            for _ in terms:
+                self.symstates.put_solver_stats(
+                    analysis.MaxSolverCalls(z3.unknown))
+            return [(loc, term, None) for term in terms]
+
+        def timeout(task):
+            # each term of a batch has its own optimizer calls
+            _, terms = task
+            return settings.TASK_TIMEOUT * (
+                len(terms) if isinstance(terms, list) else 1)
+
+        wrs = helpers.miscs.Miscs.irun_mp(
+            'optimize upperbound', tasks, f, cost, timeout=timeout,
+            phase_timeout=settings.PHASE_TIMEOUT, on_timeout=on_timeout)
 
         dinvs = data.inv.invs.DInvs()
         for loc, term, v in wrs:
             if v is None:
                 continue
             inv = self.inv_cls(term.mk_le(v))
-            inv.set_stat(data.inv.base.Inv.PROVED)
+            inv.set_stat(data.inv.base.Inv.UNKNOWN
+                         if loc in self.symstates.truncated
+                         else data.inv.base.Inv.PROVED)
             dinvs.setdefault(loc, data.inv.invs.Invs()).add(inv)
 
         return dinvs
@@ -83,8 +123,73 @@ class Infer(infer.base.Infer, metaclass=ABCMeta):
         if term.eval_traces(dtraces[loc], lambda v: int(v) > settings.IUPPER):
             return None
 
+        term_expr = self.to_expr(term)
+        lower = None
+        if settings.DO_SEED_BOUNDS:
+            v, lower = self.check_traces_bound(
+                loc, term, term_expr, extra_constr, dtraces)
+            if v is not None:
+                return v
+            if lower is not None and lower[1] > settings.IUPPER:
+                return None
+
         return self.symstates.maximize(
-            loc, self.to_expr(term), extra_constr)
+            loc, term_expr, extra_constr, lower)
+
+    def check_traces_bound(self, loc, term, term_expr, extra_constr, dtraces):
+        """
+        Check term <= m, where m is the max value of term over the traces,
+        using a plain satisfiability query.
+        Return (m, None) if it holds (m is the upperbound), otherwise
+        (None, lower), where lower is (depth, value of term at the cex),
+        or None if unknown or if no symstates satisfy extra_constr.
+        """
+        m = max(term.eval_traces(dtraces[loc], None))
+        stat, depth, cexv = self.symstates.check_upper(
+            loc, term_expr, m, extra_constr)
+        if stat == z3.unsat:
+            m = helpers.miscs.Miscs.to_pynum(m)
+            return (m if isinstance(m, int) else
+                    helpers.miscs.Miscs.to_sagenum(m)), None
+        elif stat == z3.sat and cexv is not None:
+            return None, (depth, cexv)
+        return None, None
+
+    def maximize_terms(self, loc, terms, extra_constr, dtraces):
+        """
+        Like maximize for each term, but using one optimizer session
+        (per depth) for all terms
+        """
+        assert isinstance(terms, list) and terms, terms
+        assert isinstance(
+            dtraces, data.traces.DTraces) and dtraces and dtraces[loc], dtraces
+
+        # check if concrete states(traces) exceed upperbound
+        idxs = [i for i, term in enumerate(terms)
+                if not term.eval_traces(
+                    dtraces[loc], lambda v: int(v) > settings.IUPPER)]
+
+        vs = [None] * len(terms)
+        if settings.DO_SEED_BOUNDS:
+            # lower bounds are not used because the terms share the
+            # constraints of the optimizer
+            idxs_ = []
+            for i in idxs:
+                v, lower = self.check_traces_bound(
+                    loc, terms[i], self.to_expr(terms[i]), extra_constr,
+                    dtraces)
+                if v is not None:
+                    vs[i] = v
+                elif lower is None or lower[1] <= settings.IUPPER:
+                    idxs_.append(i)
+            idxs = idxs_
+
+        if idxs:
+            vs_ = self.symstates.maximize_terms(
+                loc, [self.to_expr(terms[i]) for i in idxs], extra_constr)
+            for i, v in zip(idxs, vs_):
+                vs[i] = v
+        return vs
 
     def get_terms(self, symbols, traces):
 
@@ -6,9 +6,10 @@ import pdb
 import z3
 import sage.all
 import helpers.vcommon as CM
-from helpers.miscs import Miscs
+from helpers.miscs import Miscs, Z3
 
 import settings
+import analysis
 import infer.base
 from data.traces import Traces, DTraces
 from data.inv.base import Inv
@@ -199,14 +200,15 @@ class Infer(infer.base.Infer):
 
         preconds = sorted(preconds, key=lambda p: len(Miscs.get_vars(p.inv)))
         preconds_exprs = [pc.expr(self.use_reals) for pc in preconds]
-        if not self.check(preconds_exprs, postcond_expr, loc):
+        solver = self.symstates.get_solver(loc, None, False)
+        stats = []
+        results = Z3.simplify_conj(
+            preconds_exprs, postcond_expr, solver, stats)
+        for stat in stats:
+            self.symstates.put_solver_stats(analysis.CheckSolverCalls(stat))
+        if results is None:
             return []
 
-        def _imply(js, _):
-            jexprs = [preconds_exprs[j] for j in js]
-            return self.check(jexprs, postcond_expr, loc)
-
-        results = Miscs.simplify_idxs(list(range(len(preconds))), _imply)
         results = [preconds[i] for i in results]
         return results
 
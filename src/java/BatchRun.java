@@ -0,0 +1,113 @@
+import java.io.BufferedReader;
+import java.io.InputStreamReader;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.lang.reflect.Modifier;
+
+/*
+  Batch driver for the instrumented (trace) class args[0]:
+  run its mainQ on many inputs, one input per line of stdin,
+  e.g., "3 7" for mainQ(int x, int y),
+  and print "vinput: i" before the traces of the i-th input.
+  This avoids starting a JVM for each input, but static state of the
+  class (e.g., static fields) is not reset between inputs.
+
+  Server mode (args[1] is a timeout in ms): keep running until stdin is
+  closed, run each input under a watchdog that stops runs longer than
+  the timeout, and print "vdone: i ok" (or "vdone: i timeout")
+  after the traces of the i-th input.
+*/
+public class BatchRun {
+     public static Method getMainQ(Class<?> c){
+	  for (Method m: c.getDeclaredMethods()){
+	       if (m.getName().startsWith("mainQ") &&
+		   Modifier.isStatic(m.getModifiers())){
+		    m.setAccessible(true);
+		    return m;
+	       }
+	  }
+	  return null;
+     }
+
+     public static Object[] parseArgs(Class<?>[] typs, String[] vs){
+	  Object[] args = new Object[typs.length];
+	  for (int i = 0; i < typs.length; ++i){
+	       if (typs[i] == int.class){
+		    args[i] = Integer.parseInt(vs[i]);
+	       }
+	       else if (typs[i] == double.class){
+		    args[i] = Double.parseDouble(vs[i]);
+	       }
+	       else if (typs[i] == float.class){
+		    args[i] = Float.parseFloat(vs[i]);
+	       }
+	       else{
+		    throw new IllegalArgumentException("Didn't consider " + typs[i]);
+	       }
+	  }
+	  return args;
+     }
+
+     public static void invoke(Method mainQ, Object[] args){
+	  try{
+	       mainQ.invoke(null, args);
+	  }
+	  catch(InvocationTargetException e){
+	       /*e.g., failed assertions, which also end a separate run*/
+	       e.getCause().printStackTrace();
+	  }
+	  catch(IllegalAccessException e){
+	       e.printStackTrace();
+	  }
+     }
+
+     @SuppressWarnings("deprecation")
+     public static boolean invoke(final Method mainQ, final Object[] args,
+				  long timeout) throws InterruptedException {
+	  Thread t = new Thread(new Runnable(){
+		    public void run(){
+			 invoke(mainQ, args);
+		    }
+	       });
+	  t.setDaemon(true);
+	  t.start();
+	  t.join(timeout);
+	  if (!t.isAlive()){
+	       return true;
+	  }
+	  /*e.g., mainQ loops, Thread.stop is the only way to end it*/
+	  t.stop();
+	  t.join(timeout);
+	  return false;
+     }
+
+     public static void main(final String args[]) throws Exception {
+	  Method mainQ = getMainQ(Class.forName(args[0]));
+	  assert(mainQ != null);
+	  Class<?>[] typs = mainQ.getParameterTypes();
+	  boolean isServer = args.length > 1;
+	  long timeout = isServer ? Long.parseLong(args[1]) : 0;
+
+	  BufferedReader br = new BufferedReader(new InputStreamReader(System.in));
+	  String line;
+	  int idx = 0;
+	  while ((line = br.readLine()) != null){
+	       line = line.trim();
+	       if (line.isEmpty()){
+		    continue;
+	       }
+	       System.out.println("vinput: " + idx);
+	       Object[] inps = parseArgs(typs, line.split("\\s+"));
+	       if (isServer){
+		    boolean isDone = invoke(mainQ, inps, timeout);
+		    System.out.println(
+			 "vdone: " + idx + " " + (isDone ? "ok" : "timeout"));
+	       }
+	       else{
+		    invoke(mainQ, inps);
+	       }
+	       System.out.flush();
+	       idx += 1;
+	  }
+     }
+}
@@ -30,8 +30,15 @@ import java.util.stream.Collectors;
 public class InvariantListenerVu
      extends PropertyListenerAdapter implements PublisherExtension {
 
+     private Search search;
+
      public InvariantListenerVu (Config conf, JPF jpf) {}
 
+     @Override
+     public void searchStarted (Search search){
+	  this.search = search;
+     }
+
      private ChoiceGenerator<?>  findPCChoiceGenerator(VM vm){
 	  ChoiceGenerator <?>cg = vm.getChoiceGenerator();
 	  if (!(cg instanceof PCChoiceGenerator)){
@@ -92,6 +99,10 @@ public class InvariantListenerVu
 			 StackFrame sf = ti.getTopFrame();
 			 out.printf("********** START **********\n");
 			 out.printf("loc: %s\n", methodName);
+			 // smallest search.depth_limit reaching this state
+			 if (search != null){
+			      out.printf("depth: %d\n", search.getDepth() + 1);
+			 }
 			 printPCs(conf, vm, mi);
 			 printLocals(mi, sf);
 			 out.printf("********** END **********\n");
@@ -104,6 +104,46 @@ let create_inps (vars:varinfo list): string list =
     ) vars
                        
 
+let create_batch_main (mainQ_fd:fundec) : string option =
+  (** create a main running mainQ on many inputs, one input per line of stdin,
+      and printing "vinput: i" before the traces of the i-th input, e.g.,
+      int main(int argc, char **argv){
+        int x; int y;
+        int dig_i = 0;
+        while (scanf("%d %d", &x, &y) == 2){
+          printf("vinput: %d\n", dig_i++); fflush(stdout);
+          mainQ(x, y); fflush(stdout);
+        }
+        return 0;
+      }
+      None if mainQ has no params or params that are neither int nor double,
+      as scanf would then read nothing (and loop forever) or the wrong type
+   **)
+  let vs = mainQ_fd.sformals in
+  let is_int vi = vi.vtype = intType in
+  let is_double vi = vi.vtype = doubleType in
+  if vs = [] || not (L.for_all (fun vi -> is_int vi || is_double vi) vs)
+  then None else
+  let decls = L.map (fun vi ->
+                  (if is_int vi then "int " else "double ") ^ vi.vname ^ ";"
+                ) vs in
+  let fmts = L.map (fun vi -> if is_int vi then "%d" else "%lf") vs in
+  let addrs = L.map (fun vi -> "&" ^ vi.vname) vs in
+  let args = L.map (fun vi -> vi.vname) vs in
+  Some (S.concat "\n" [
+      "int main(int argc, char **argv){";
+      "  " ^ S.concat " " decls;
+      "  int dig_i = 0;";
+      P.sprintf "  while (scanf(\"%s\", %s) == %d){"
+        (S.concat " " fmts) (S.concat ", " addrs) (L.length vs);
+      "    printf(\"vinput: %d\\n\", dig_i++); fflush(stdout);";
+      P.sprintf "    %s(%s); fflush(stdout);"
+        mainQ_fd.svar.vname (S.concat ", " args);
+      "  }";
+      "  return 0;";
+      "}"])
+
+
 class change_vassume_visitor vassume changeto = object
   (*
     change vassume(..) to $assume(..)
@@ -131,6 +171,8 @@ let () = begin
     let src = Sys.argv.(1) in
     let civl_src = Sys.argv.(2) in   (*instrument for CIVL*)
     let trace_src = Sys.argv.(3) in (*instrument for execution*)
+    (*instrument for batch execution, optional*)
+    let batch_src = if Array.length Sys.argv > 4 then Some Sys.argv.(4) else None in
     (*let cil_src = civl_src ^ ".cil.c"  in (*instrument for execution*)*)
 
     let ast_civl = Frontc.parse src () in    
@@ -185,7 +227,25 @@ let () = begin
     let adds = S.concat "\n" includes in
     ast_trace.globals <- (GText adds):: ast_trace.globals;
     
-    CM.writeSrc trace_src ast_trace
+    CM.writeSrc trace_src ast_trace;
+
+
+    (* Batch Execution, i.e., main runs mainQ on many inputs from stdin *)
+    match batch_src with
+    | None -> ()
+    | Some batch_src ->
+       let ast_batch = CM.copyObj ast_trace in
+       let mainQ_fd:fundec = CM.find_fun ast_batch mainQ in
+       match create_batch_main mainQ_fd with
+       | None -> E.warn "%s: unsupported params, no batch main" mainQ
+       | Some batch_main ->
+          ast_batch.globals <- L.filter (fun g ->
+                                   match g with
+                                   |GFun(f, _) when f.svar.vname = "main" -> false
+                                   |_ -> true
+                                 ) ast_batch.globals;
+          ast_batch.globals <- ast_batch.globals @ [GText batch_main];
+          CM.writeSrc batch_src ast_batch
 
 end
 
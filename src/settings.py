@@ -14,11 +14,28 @@ DO_IEQS = True  # support (octagonal) inequalities
 DO_MINMAXPLUS = True  # support minmax-plus inequalities
 DO_PREPOSTS = True  # support prepostconditions #not well-tested
 DO_INCR_DEPTH = True
+DO_SE_TAG_DEPTHS = True  # one symbolic execution run tagging state depths
+DO_SS_CACHE = True  # reuse symbolic states from previous runs (SS_CACHE_DIR)
 DO_SOLVER_STATS = False
+DO_SEED_BOUNDS = True  # check max values over traces before optimizing
+DO_BOX_OPT = True  # find upperbounds of terms at a loc in one optimizer
+DO_BATCH_CHECK = True  # check invs at a loc together using guard literals
+DO_RANK_PROBE = True  # float rank probe to prune terms before solving eqts
+DO_OCT_CLOSURE = True  # remove implied octagonal invs using octagon closure
+# Note: both run many inps in one process, so static state (e.g., a static
+# field updated by mainQ) persists across inps; turn them off for such progs
+DO_BATCH_TRACES = True  # run the program on many inps per process
+DO_TRACE_SERVER = True  # run (Java) programs in one long-lived process
 
 INP_MAX_V = 300
 SYMEXE_TIMEOUT = 20  # secs
+SE_MAX_PCS = 0  # if set, keep at most this many pcs per loc (not proved)
 SOLVER_TIMEOUT = 5 * 1000  # 5 secs
+TASK_TIMEOUT = 120  # secs per inv (or term) of a parallel solver task
+PHASE_TIMEOUT = 600  # secs, all parallel solver tasks are killed after this
+PROG_TIMEOUT = 5  # secs, running the program on an input is killed after this
+GROEBNER_TIMEOUT = 30  # secs, for reducing nonlinear eqts
+PARSE_CACHE_SIZE = 20000  # z3 exprs kept by Z3.parse (per process)
 # EQT_SOLVER_TIMEOUT = 120  # secs
 EQT_RATE = 1.5
 MAX_LARGE_COEF = 50
@@ -42,9 +59,14 @@ POST_LOC = 'post'  # vtraceX_post  indicates postconditions
 # Program Paths
 SRC_DIR = Path(__file__).parent
 
+SS_CACHE_DIR = "dig_sscache"  # under tmpdir
+SS_CACHE_MAX_AGE = 30  # days, unused cached symstates are removed after
+SS_CACHE_MAX_SIZE = 500  # MB, least recently used cached symstates are removed
 TRACE_DIR = "traces"
 SYMEXE_DIR = "symexe"
 TRACE_INDICATOR = "vtrace"
+BATCH_INDICATOR = "vinput"  # vinput: i, the traces of the i-th inp follow
+SERVER_INDICATOR = "vdone"  # vdone: i ok|timeout, end of the i-th inp
 MAINQ_FUN = "mainQ"
 
 # Must be Java 8 because JPF requires Java 8
@@ -68,6 +90,8 @@ class Java:
     JPF_HOME = Path(os.path.expandvars("$JPF_HOME")) / "jpf-core"
     JPF_JAR = JPF_HOME / "build/RunJPF.jar"
     assert JPF_JAR.is_file(), JPF_JAR
+    # symbolic extension, with InvariantListenerVu (see README)
+    JPF_SYMBC_JAR = JPF_HOME.parent / "jpf-symbc/build/jpf-symbc.jar"
     JVM_FLAGS = "-Xmx1024m -ea"
 
     JPF_RUN = "{java} {flags} -jar {jar} {jpffile}"
@@ -84,6 +108,16 @@ class Java:
     JAVA_RUN = "{java} -ea -cp {tracedir} {funname}"
     JAVA_RUN = partial(JAVA_RUN.format, java=JAVA_CMD)
 
+    BATCH_RUN_CLASS = JAVA_INSTRUMENT_DIR / "BatchRun.class"
+    JAVA_BATCH_RUN = "{java} -ea -cp {cp}:{tracedir} BatchRun {funname}"
+    JAVA_BATCH_RUN = partial(JAVA_BATCH_RUN.format, java=JAVA_CMD,
+                             cp=JAVA_INSTRUMENT_DIR)
+    # BatchRun in server mode, each inp is stopped after timeout (ms)
+    JAVA_SERVER_RUN = ("{java} -ea -cp {cp}:{tracedir} BatchRun {funname} "
+                       "{timeout}")
+    JAVA_SERVER_RUN = partial(JAVA_SERVER_RUN.format, java=JAVA_CMD,
+                              cp=JAVA_INSTRUMENT_DIR)
+
 
 class C:
     GCC_CMD = "gcc"
@@ -94,7 +128,8 @@ class C:
     COMPILE = partial(COMPILE.format, gcc=GCC_CMD)
 
     INSTRUMENT_EXE = CIL_INSTRUMENT_DIR / "instr.exe"
-    INSTRUMENT = "{instrument_exe} {filename} {symexefile} {tracefile}"
+    INSTRUMENT = ("{instrument_exe} {filename} {symexefile} {tracefile} "
+                  "{batchfile}")
     INSTRUMENT = partial(INSTRUMENT.format, instrument_exe=INSTRUMENT_EXE)
 
     C_RUN = "{exe}"
@@ -161,6 +196,12 @@ def setup(settings, args):
         else:
             opts.append("-noincredepth")
 
+    if args.nosscache:
+        if settings:
+            settings.DO_SS_CACHE = not args.nosscache
+        else:
+            opts.append("-nosscache")
+
     if args.dosolverstats:
         if settings:
             settings.DO_SOLVER_STATS = args.dosolverstats